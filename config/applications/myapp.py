@@ -24,6 +24,9 @@ class AppleMyappHeaders(AppleHeaders):
     """
     An Apple headers structure for a push notification
 
+    If the headers only depend on app_id and event, set cache_headers = True
+    and override static_headers instead, they are then built once per event.
+
 
     @property
     def headers(self):
@@ -1 +1 @@
-__all__ = ['api', 'home', 'push', 'v2']
+__all__ = ['api', 'breakers', 'home', 'metrics', 'push', 'v2']
@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from pushserver.resources import settings
+from pushserver.resources.utils import check_host, log_event
+
+router = APIRouter()
+
+
+def get_breakers() -> dict:
+    return {(app_id, platform): entries['breaker']
+            for (app_id, platform), entries in settings.params.pns_register.items()
+            if entries.get('breaker') is not None}
+
+
+@router.get('')
+async def breakers(request: Request):
+
+    host, port = request.client.host, request.client.port
+
+    if check_host(host, settings.params.allowed_pool):
+        code = 200
+        description = 'circuit breakers'
+        data = {f'{app_id} {platform}': breaker.stats()
+                for (app_id, platform), breaker in get_breakers().items()}
+    else:
+        msg = f'incoming request from {host} is denied'
+        log_event(loggers=settings.params.loggers,
+                  msg=msg, level='deb')
+        code = 403
+        description = 'access denied by access list'
+        data = {}
+
+    return JSONResponse(status_code=code, content={'code': code,
+                                                   'description': description,
+                                                   'data': data})
+
+
+@router.post('/{app_id}/{platform}/reset')
+async def reset_breaker(app_id: str, platform: str, request: Request):
+
+    host, port = request.client.host, request.client.port
+
+    if check_host(host, settings.params.allowed_pool):
+        breaker = get_breakers().get((app_id, platform))
+        if breaker is None:
+            code = 404
+            description = 'circuit breaker not found'
+            data = {'app_id': app_id, 'platform': platform}
+        else:
+            breaker.reset()
+            code = 200
+            description = 'circuit breaker closed'
+            data = breaker.stats()
+    else:
+        msg = f'incoming request from {host} is denied'
+        log_event(loggers=settings.params.loggers,
+                  msg=msg, level='deb')
+        code = 403
+        description = 'access denied by access list'
+        data = {}
+
+    return JSONResponse(status_code=code, content={'code': code,
+                                                   'description': description,
+                                                   'data': data})
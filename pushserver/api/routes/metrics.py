@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from pushserver.resources import settings
+from pushserver.resources.calls import CallRegistry
+from pushserver.resources.dedup import RequestCache
+from pushserver.resources.delivery import DeliveryQueue
+from pushserver.resources.logs import LogQueue
+from pushserver.resources.metrics import PushMetrics
+from pushserver.resources.remotelog import RemoteLogShipper
+from pushserver.resources.scheduler import RetryScheduler
+from pushserver.resources.storage import TokenStorage
+from pushserver.resources.utils import check_host, log_event
+
+router = APIRouter()
+
+
+@router.get('')
+async def metrics(request: Request):
+
+    host, port = request.client.host, request.client.port
+
+    if check_host(host, settings.params.allowed_pool):
+        code = 200
+        description = 'server metrics'
+        pns_register = settings.params.pns_register
+        data = {'calls': CallRegistry().stats(),
+                'connections': {f'{app_id} {platform}': entries['conn'].stats()
+                                for (app_id, platform), entries in pns_register.items()
+                                if hasattr(entries.get('conn'), 'stats')},
+                'delivery_queue': DeliveryQueue().stats(),
+                'duplicates': RequestCache().stats(),
+                'logs': LogQueue().stats(),
+                'pushes': PushMetrics().stats(),
+                'remote_logs': RemoteLogShipper().stats(),
+                'retries': RetryScheduler().stats(),
+                'storage': TokenStorage().stats(),
+                'throttle': {f'{app_id} {platform}': entries['rate_limiter'].stats()
+                             for (app_id, platform), entries in pns_register.items()
+                             if entries.get('rate_limiter') is not None}}
+    else:
+        msg = f'incoming request from {host} is denied'
+        log_event(loggers=settings.params.loggers,
+                  msg=msg, level='deb')
+        code = 403
+        description = 'access denied by access list'
+        data = {}
+
+    return JSONResponse(status_code=code, content={'code': code,
+                                                   'description': description,
+                                                   'data': data})
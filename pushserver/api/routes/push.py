@@ -1,10 +1,14 @@
+import asyncio
 import json
 
-from fastapi import APIRouter, BackgroundTasks, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request, status
 
 from pushserver.models.requests import WakeUpRequest, fix_platform_name
 from pushserver.resources import settings
+from pushserver.resources.calls import CallRegistry
+from pushserver.resources.codec import JSONResponse
+from pushserver.resources.dedup import RequestCache
+from pushserver.resources.delivery import DeliveryQueue, priority_class
 from pushserver.resources.notification import handle_request
 from pushserver.resources.utils import (check_host,
                                         log_event, log_incoming_request)
@@ -14,11 +18,18 @@ router = APIRouter()
 
 @router.post('', response_model=WakeUpRequest)
 async def push_requests(request: Request,
-                        wp_request: WakeUpRequest,
-                        background_tasks: BackgroundTasks):
+                        wp_request: WakeUpRequest):
 
     wp_request.platform = fix_platform_name(wp_request.platform)
 
+    key = (request.client.host, request.url.path,
+           f"{wp_request.event}-{wp_request.app_id}-{wp_request.call_id}", wp_request.token)
+    return await RequestCache().run(key, send_push_request, request, wp_request)
+
+
+async def send_push_request(request: Request,
+                            wp_request: WakeUpRequest):
+
     host, port = request.client.host, request.client.port
 
     code, description, data = '', '', {}
@@ -26,17 +37,33 @@ async def push_requests(request: Request,
     if check_host(host, settings.params.allowed_pool):
         request_id = f"{wp_request.event}-{wp_request.app_id}-{wp_request.call_id}"
 
+        if wp_request.event == 'cancel':
+            CallRegistry().cancel(CallRegistry.key(wp_request.sip_to, wp_request.call_id))
+
         if not settings.params.return_async:
-            background_tasks.add_task(log_incoming_request, task='log_request',
-                                      host=host, loggers=settings.params.loggers,
-                                      request_id=request_id, body=wp_request.__dict__)
-
-            background_tasks.add_task(log_incoming_request, task='log_success',
-                                      host=host, loggers=settings.params.loggers,
-                                      request_id=request_id, body=wp_request.__dict__)
-            background_tasks.add_task(handle_request,
-                                      wp_request=wp_request,
-                                      request_id=request_id)
+            log_incoming_request(task='log_request',
+                                 host=host, loggers=settings.params.loggers,
+                                 request_id=request_id, body=wp_request.__dict__)
+            try:
+                DeliveryQueue().submit(handle_request,
+                                       priority=priority_class(wp_request.event,
+                                                               wp_request.media_type),
+                                       wp_request=wp_request,
+                                       request_id=request_id)
+            except asyncio.QueueFull:
+                code, description = 503, 'delivery queue is full'
+                log_incoming_request(task='log_failure',
+                                     host=host, loggers=settings.params.loggers,
+                                     request_id=request_id, body=wp_request.__dict__,
+                                     error_msg=description)
+                return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    content={'code': code,
+                                             'description': description,
+                                             'data': {}})
+
+            log_incoming_request(task='log_success',
+                                 host=host, loggers=settings.params.loggers,
+                                 request_id=request_id, body=wp_request.__dict__)
             status_code, code = status.HTTP_202_ACCEPTED, 202
             description, data = 'accepted for delivery', {}
 
@@ -59,10 +86,13 @@ async def push_requests(request: Request,
             log_incoming_request(task='log_success',
                                  host=host, loggers=settings.params.loggers,
                                  request_id=request_id, body=wp_request.__dict__)
-            results = handle_request(wp_request, request_id=request_id)
+            results = await handle_request(wp_request, request_id=request_id)
             code = results.get('code')
             description = 'push notification response'
             data = results
+            if code == 487:
+                # not an error of the request, the call was cancelled
+                code, description = 200, 'push notification not sent, call was cancelled'
 
     else:
         msg = f'incoming request from {host} is denied'
@@ -1,7 +1,7 @@
+import asyncio
 import json
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Request, status
 
 from fastapi.encoders import jsonable_encoder
 from pydantic import ValidationError
@@ -9,44 +9,49 @@ from typing import Optional
 
 from pushserver.models.requests import WakeUpRequest, PushRequest
 from pushserver.resources import settings
+from pushserver.resources.calls import CallRegistry
+from pushserver.resources.codec import JSONResponse
+from pushserver.resources.dedup import RequestCache
+from pushserver.resources.delivery import DeliveryQueue, priority_class
 from pushserver.resources.storage import TokenStorage
 from pushserver.resources.storage.errors import StorageError
-from pushserver.resources.notification import handle_request
+from pushserver.resources.notification import SharedPayloads, handle_request
 from pushserver.resources.utils import (check_host,
-                                        log_event, log_incoming_request,
+                                        log_enabled, log_event, log_incoming_request,
                                         log_push_request,
                                         fix_platform_name)
 
 router = APIRouter()
 
 
-async def task_push(account: str,
-                    push_request: PushRequest,
-                    request_id: str,
-                    host: str,
-                    device: Optional[str] = None):
-
-    code, description, data = '', '', []
-    storage = TokenStorage()
-    try:
-        storage_data = storage[account]
-    except StorageError:
-        log_push_request(task='log_failure',
-                         host=host, loggers=settings.params.loggers,
-                         request_id=request_id, body=push_request.__dict__,
-                         error_msg=f'500: {{\"detail\": \"{error.detail}\"}}')
-        return
-    expired_devices = []
-
-    if not storage_data:
-        # Push request was not sent: user not found
-        storage.remove(account)
-        return
+async def push_devices(storage_data: dict,
+                       push_request: PushRequest,
+                       request_id: str,
+                       host: str,
+                       device: Optional[str] = None,
+                       account: Optional[str] = None) -> tuple:
+    """
+    Send a push notification to the devices of an account.
+    Deliveries are started concurrently, at most fanout_concurrency
+    at a time, and their results are collected in storage order.
+    Devices of the same app share the payload, serialized once.
+
+    :param storage_data: `dict` with the push parameters of each device (from TokenStorage)
+    :param push_request: `PushRequest`, received from the push route.
+    :param request_id: `str`, request ID generated on request event.
+    :param host: `str` client host where request comes from
+    :param device: `str` (optional) deliver only to this device id
+    :param account: `str` (optional) account of the devices, cancels are by account and call_id
+    :return: a `tuple` with the code of the last device in storage order, the results,
+    the expired devices and an error message if a wake up request is not valid.
+    """
+    wake_up_requests = []
 
     for device_key, push_parameters in storage_data.items():
         if device is not None and device != push_parameters['device_id']:
             continue
 
+        push_parameters = dict(push_parameters)
         push_parameters.update(push_request.__dict__)
 
         push_parameters['platform'] = fix_platform_name(push_parameters['platform'])
@@ -60,8 +65,8 @@ async def task_push(account: str,
                 item = item.replace('_', '-')
             reversed_push_parameters[item] = value
 
-        # Use background_token for cancel
-        if push_parameters['event'] == 'cancel' and push_parameters['background_token'] is not None:
+        # Use background_token for cancel and message
+        if push_parameters['event'] in ('cancel', 'message') and push_parameters['background_token'] is not None:
             reversed_push_parameters['token'] = push_parameters['background_token']
 
         # if push_parameters['silent']:
@@ -71,35 +76,90 @@ async def task_push(account: str,
             wp = WakeUpRequest(**reversed_push_parameters)
         except ValidationError as e:
             error_msg = e.errors()[0]['msg']
-            log_push_request(task='log_failure', host=host,
-                             loggers=settings.params.loggers,
-                             request_id=request_id, body=push_request.__dict__,
-                             error_msg=error_msg)
-            return
+            return '', [], [], error_msg
 
-        log_incoming_request(task='log_success',
-                             host=host, loggers=settings.params.loggers,
-                             request_id=request_id, body=wp.__dict__)
-        results = handle_request(wp, request_id=request_id)
+        wake_up_requests.append((push_parameters, wp))
+
+    semaphore = asyncio.Semaphore(settings.params.fanout_concurrency)
+    shared_payloads = SharedPayloads(wp for push_parameters, wp in wake_up_requests)
+
+    async def push_device(push_parameters: dict, wp: WakeUpRequest) -> tuple:
+        async with semaphore:
+            log_incoming_request(task='log_success',
+                                 host=host, loggers=settings.params.loggers,
+                                 request_id=request_id, body=wp.__dict__)
+            results = await handle_request(wp, request_id=request_id,
+                                           shared_payloads=shared_payloads,
+                                           account=account)
+        return push_parameters, results
+
+    code, data, expired_devices = '', [], []
+
+    tasks = [asyncio.ensure_future(push_device(push_parameters, wp))
+             for push_parameters, wp in wake_up_requests]
+    try:
+        deliveries = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
+    for push_parameters, results in deliveries:
         code = results.get('code')
         if code == 410:
             expired_devices.append((push_parameters['app_id'], push_parameters['device_id']))
             code = 200
-        description = 'push notification responses'
+        elif code == 487:
+            # not sent, the call was cancelled
+            code = 200
         data.append(results)
 
-    for device in expired_devices:
-        msg = f'Removing {device[1]} from {account}'
+    return code, data, expired_devices, ''
+
+
+async def task_push(account: str,
+                    push_request: PushRequest,
+                    request_id: str,
+                    host: str,
+                    device: Optional[str] = None):
+
+    storage = TokenStorage()
+    try:
+        storage_data = await storage.lookup(account)
+    except StorageError:
+        log_push_request(task='log_failure',
+                         host=host, loggers=settings.params.loggers,
+                         request_id=request_id, body=push_request.__dict__,
+                         error_msg='500: {"detail": "Internal error: storage"}')
+        return
+    if not storage_data:
+        # Push request was not sent: user not found
+        storage.remove(account)
+        return
+
+    code, data, expired_devices, error_msg = await push_devices(storage_data, push_request,
+                                                                request_id, host, device,
+                                                                account=account)
+    if error_msg:
+        log_push_request(task='log_failure', host=host,
+                         loggers=settings.params.loggers,
+                         request_id=request_id, body=push_request.__dict__,
+                         error_msg=error_msg)
+        return
+
+    description = 'push notification responses'
+
+    for expired_device in expired_devices:
+        msg = f'Removing {expired_device[1]} from {account}'
         log_event(loggers=settings.params.loggers,
                   msg=msg, level='deb')
-        storage.remove(account, *device)
+        storage.remove(account, *expired_device)
 
     if code == '':
-        description, data = 'Push request was not sent: device not found', {"device_id": push_parameters['device_id']}
+        description, data = 'Push request was not sent: device not found', {"device_id": device}
         log_event(loggers=settings.params.loggers,
                   msg=f'{description} {data}', level='warn')
-    else:
+    elif log_enabled(settings.params.loggers, 'deb'):
         log_event(loggers=settings.params.loggers,
                   msg=f'{description} {data}', level='deb')
 
@@ -109,9 +169,19 @@ async def task_push(account: str,
 async def push_requests(account: str,
                         request: Request,
                         push_request: PushRequest,
-                        background_tasks: BackgroundTasks,
                         device: Optional[str] = None):
 
+    key = (request.client.host, request.url.path,
+           f"{push_request.event}-{account}-{push_request.call_id}")
+    return await RequestCache().run(key, send_push_request, account, request,
+                                    push_request, device)
+
+
+async def send_push_request(account: str,
+                            request: Request,
+                            push_request: PushRequest,
+                            device: Optional[str] = None):
+
     host, port = request.client.host, request.client.port
 
     code, description, data = '', '', []
@@ -119,19 +189,36 @@ async def push_requests(account: str,
     if check_host(host, settings.params.allowed_pool):
         request_id = f"{push_request.event}-{account}-{push_request.call_id}"
 
+        if push_request.event == 'cancel':
+            CallRegistry().cancel(CallRegistry.key(account, push_request.call_id))
+
         if not settings.params.return_async:
-            background_tasks.add_task(log_push_request, task='log_request',
-                                      host=host, loggers=settings.params.loggers,
-                                      request_id=request_id, body=push_request.__dict__)
-            background_tasks.add_task(log_incoming_request, task='log_success',
-                                      host=host, loggers=settings.params.loggers,
-                                      request_id=request_id, body=push_request.__dict__)
-            background_tasks.add_task(task_push,
-                                      account=account,
-                                      push_request=push_request,
-                                      request_id=request_id,
-                                      host=host,
-                                      device=device)
+            log_push_request(task='log_request',
+                             host=host, loggers=settings.params.loggers,
+                             request_id=request_id, body=push_request.__dict__)
+            try:
+                DeliveryQueue().submit(task_push,
+                                       priority=priority_class(push_request.event,
+                                                               push_request.media_type),
+                                       account=account,
+                                       push_request=push_request,
+                                       request_id=request_id,
+                                       host=host,
+                                       device=device)
+            except asyncio.QueueFull:
+                code, description = 503, 'delivery queue is full'
+                log_push_request(task='log_failure',
+                                 host=host, loggers=settings.params.loggers,
+                                 request_id=request_id, body=push_request.__dict__,
+                                 error_msg=description)
+                return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    content={'code': code,
+                                             'description': description,
+                                             'data': {}})
+
+            log_incoming_request(task='log_success',
+                                 host=host, loggers=settings.params.loggers,
+                                 request_id=request_id, body=push_request.__dict__)
             status_code, code = status.HTTP_202_ACCEPTED, 202
             description, data = 'accepted for delivery', {}
 
@@ -149,7 +236,7 @@ async def push_requests(account: str,
         else:
             storage = TokenStorage()
             try:
-                storage_data = storage[account]
+                storage_data = await storage.lookup(account)
             except StorageError:
                 error = HTTPException(status_code=500, detail="Internal error: storage")
                 log_push_request(task='log_failure',
@@ -157,7 +244,6 @@ async def push_requests(account: str,
                                  request_id=request_id, body=push_request.__dict__,
                                  error_msg=f'500: {{\"detail\": \"{error.detail}\"}}')
                 raise error
-            expired_devices = []
 
             log_push_request(task='log_request',
                              host=host, loggers=settings.params.loggers,
@@ -170,55 +256,21 @@ async def push_requests(account: str,
                                              'description': description,
                                              'data': data})
 
-            for device_key, push_parameters in storage_data.items():
-                if device is not None and device != push_parameters['device_id']:
-                    continue
-
-                push_parameters.update(push_request.__dict__)
-
-                push_parameters['platform'] = fix_platform_name(push_parameters['platform'])
-
-                reversed_push_parameters = {}
-                for item in push_parameters.keys():
-                    value = push_parameters[item]
-                    if item in ('sip_to', 'sip_from'):
-                        item = item.split('_')[1]
-                    else:
-                        item = item.replace('_', '-')
-                    reversed_push_parameters[item] = value
-
-                # Use background_token for cancel and message
-                if push_parameters['event'] in ('cancel', 'message') and push_parameters['background_token'] is not None:
-                    reversed_push_parameters['token'] = push_parameters['background_token']
-
-                # if push_parameters['silent']:
-                #    continue
-
-                try:
-                    wp = WakeUpRequest(**reversed_push_parameters)
-                except ValidationError as e:
-                    error_msg = e.errors()[0]['msg']
-                    log_push_request(task='log_failure', host=host,
-                                     loggers=settings.params.loggers,
-                                     request_id=request_id, body=push_request.__dict__,
-                                     error_msg=error_msg)
-                    content = jsonable_encoder({'code': 400,
-                                                'description': error_msg,
-                                                'data': ''})
-                    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                                        content=content)
-
-                log_incoming_request(task='log_success',
-                                     host=host, loggers=settings.params.loggers,
-                                     request_id=request_id, body=wp.__dict__)
-                results = handle_request(wp, request_id=request_id)
-
-                code = results.get('code')
-                if code == 410:
-                    expired_devices.append((push_parameters['app_id'], push_parameters['device_id']))
-                    code = 200
-                description = 'push notification responses'
-                data.append(results)
+            code, data, expired_devices, error_msg = await push_devices(storage_data, push_request,
+                                                                        request_id, host, device,
+                                                                        account=account)
+            if error_msg:
+                log_push_request(task='log_failure', host=host,
+                                 loggers=settings.params.loggers,
+                                 request_id=request_id, body=push_request.__dict__,
+                                 error_msg=error_msg)
+                content = jsonable_encoder({'code': 400,
+                                            'description': error_msg,
+                                            'data': ''})
+                return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                                    content=content)
+
+            description = 'push notification responses'
 
             for expired_device in expired_devices:
                 msg = f'Removing {expired_device[1]} from {account}'
@@ -227,7 +279,7 @@ async def push_requests(account: str,
                 storage.remove(account, *expired_device)
 
         if code == '':
-            description, data = 'Push request was not sent: device not found', {"device_id": push_parameters['device_id']}
+            description, data = 'Push request was not sent: device not found', {"device_id": device}
             content = {'code': 404,
                        'description': description,
                        'data': data}
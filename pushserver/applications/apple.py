@@ -6,8 +6,14 @@ __all__ = ['AppleHeaders', 'ApplePayload']
 class AppleHeaders(object):
     """
     Apple headers structure for a push notification
+
+    Subclasses whose headers only depend on app_id and event can set
+    cache_headers, static_headers is then built once per app and event
+    and only the authorization is added for each push.
     """
 
+    cache_headers = False
+
     def __init__(self, app_id: str, event: str, token: str,
                  call_id: str, sip_from: str, from_display_name: str,
                  sip_to: str, media_type: str, silent: bool, reason: str,
@@ -87,10 +93,20 @@ class AppleHeaders(object):
         """
         return
 
+    @classmethod
+    def auth_headers(cls, app_id: str) -> dict:
+        """
+        Authorization headers of an app, with its current provider token
+        """
+        auth_token = settings.params.pns_register[(app_id, 'apple')]['pns'].auth_token
+        if auth_token:
+            return {'authorization': f"bearer {auth_token}"}
+        return {}
+
     @property
-    def headers(self) -> dict:
+    def static_headers(self) -> dict:
         """
-        Generate apple notification headers
+        Generate apple notification headers, without the authorization
 
         :return: a `dict` object with headers.
         """
@@ -102,14 +118,26 @@ class AppleHeaders(object):
             'apns-topic': self.apns_topic,
         }
 
-        if self.auth_token:
-            headers['authorization'] = f"bearer {self.auth_token}"
-
         if self.apns_push_type == 'background':
             headers['content-available'] = '1'
 
         return headers
 
+    @property
+    def headers(self) -> dict:
+        """
+        Generate apple notification headers
+
+        :return: a `dict` object with headers.
+        """
+
+        headers = self.static_headers
+
+        if self.auth_token:
+            headers['authorization'] = f"bearer {self.auth_token}"
+
+        return headers
+
 
 class ApplePayload(object):
     """
@@ -1,11 +1,19 @@
-from oauth2client.service_account import ServiceAccountCredentials
-
 from pushserver.resources import settings
 
 __all__ = ['FirebaseHeaders', 'FirebasePayload']
 
 
 class FirebaseHeaders(object):
+    """
+    Firebase headers structure for a push notification
+
+    Subclasses whose headers only depend on app_id and event can set
+    cache_headers, static_headers is then built once per app and event
+    and only the authorization is added for each push.
+    """
+
+    cache_headers = False
+
     def __init__(self, app_id: str, event: str, token: str,
                  call_id: str, sip_from: str, from_display_name: str,
                  sip_to: str, media_type: str, silent: bool, reason: str,
@@ -52,22 +60,43 @@ class FirebaseHeaders(object):
         except KeyError:
             self.auth_file = None
 
+        self.credentials = settings.params.pns_register.get((self.app_id, 'firebase'), {}).get('credentials')
+
     @property
     def access_token(self) -> str:
-        # https://github.com/firebase/quickstart-python/blob/909f39e77395cb0682108184ba565150caa68a31/messaging/messaging.py#L25-L33
-
         """
-        Retrieve a valid access token that can be used to authorize requests.
-        :return: `str` Access token.
+        Current access token of the service account of the app.
+        The token is minted off the event loop by the shared credentials
+        of the app, before the headers are built.
+        :return: `str` Access token, '' if none could be minted.
         """
-        scopes = ['https://www.googleapis.com/auth/firebase.messaging']
-        try:
-            credentials = ServiceAccountCredentials.from_json_keyfile_name(self.auth_file, scopes)
-            access_token_info = credentials.get_access_token()
-            return access_token_info.access_token
-        except Exception as e:
-            self.error = f"Error: cannot generated Firebase access token: {e}"
+        if self.credentials is None or not self.credentials.access_token:
+            self.error = "Error: cannot generated Firebase access token"
             return ''
+        return self.credentials.access_token
+
+    @classmethod
+    def auth_headers(cls, app_id: str) -> dict:
+        """
+        Authorization headers of an app, with its server key or current access token
+        """
+        register = settings.params.pns_register[(app_id, 'firebase')]
+        if register.get('auth_key'):
+            return {'Authorization': f"key={register['auth_key']}"}
+        credentials = register.get('credentials')
+        access_token = credentials.access_token if credentials is not None else ''
+        return {'Authorization': f"Bearer {access_token}"}
+
+    @property
+    def static_headers(self) -> dict:
+        """
+        Generate Firebase headers structure for a push notification, without the authorization
+
+        :return: a firebase push notification header.
+        """
+        if self.auth_key:
+            return {'Content-Type': 'application/json'}
+        return {'Content-Type': 'application/json; UTF-8'}
 
     @property
     def headers(self):
@@ -76,14 +105,11 @@ class FirebaseHeaders(object):
 
         :return: a firebase push notification header.
         """
+        headers = self.static_headers
         if self.auth_key:
-            headers = {'Content-Type': 'application/json',
-                       'Authorization': f"key={self.auth_key}"}
+            headers['Authorization'] = f"key={self.auth_key}"
         else:
-            headers = {
-                'Authorization': f"Bearer {self.access_token}",
-                'Content-Type': 'application/json; UTF-8',
-            }
+            headers['Authorization'] = f"Bearer {self.access_token}"
 
         return headers
 
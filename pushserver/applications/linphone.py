@@ -12,6 +12,8 @@ class AppleLinphoneHeaders(AppleHeaders):
     An Apple headers structure for a push notification
     """
 
+    cache_headers = True
+
     def create_push_type(self) -> str:
         """
         logic to define apns_push_type value using request parameters
@@ -63,6 +65,8 @@ class FirebaseLinphoneHeaders(FirebaseHeaders):
     Firebase headers for a push notification
     """
 
+    cache_headers = True
+
 
 class AppleLinphonePayload(ApplePayload):
     """
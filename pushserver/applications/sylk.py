@@ -16,6 +16,8 @@ class AppleSylkHeaders(AppleHeaders):
     An Apple headers structure for a push notification
     """
 
+    cache_headers = True
+
     def create_push_type(self) -> str:
         """
         logic to define apns_push_type value using request parameters
@@ -74,6 +76,8 @@ class FirebaseSylkHeaders(FirebaseHeaders):
     Firebase headers for a push notification
     """
 
+    cache_headers = True
+
 
 class AppleSylkPayload(ApplePayload):
     """
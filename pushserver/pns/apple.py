@@ -1,10 +1,15 @@
-import json
+import asyncio
 import jwt
 import os
 import socket
 import ssl
 import time
-from httpx import Client, ReadError
+
+import httpcore
+from application.python.types import Singleton
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from httpx import AsyncClient, ConnectError, ConnectTimeout, HTTPError, Limits, PoolTimeout, ReadError, \
+    RemoteProtocolError, WriteError
 
 from pushserver.models.requests import WakeUpRequest
 from pushserver.pns.base import PNS, PushRequest, PlatformRegister
@@ -17,13 +22,14 @@ class ApplePNS(PNS):
     """
 
     def __init__(self, app_id: str, app_name: str, url_push: str,
-                 voip: bool, cert_file: str, key_file: str, auth_token: str = None):
+                 voip: bool, cert_file: str, key_file: str, provider_token=None):
         """
         :param app_id: `str`, blunde id provided by application.
         :param url_push: `str`, URI to push a notification (from applications.ini)
         :param cert_file `str`: path to APNS certificate (provided by dev app kit)
         :param key_file `str`: path to APNS key (provided by dev app kit)
         :param voip: `bool`, Required for apple, `True` for voip push notification type.
+        :param provider_token `AppleProviderToken`: JWT used instead of a certificate.
         """
         self.app_id = app_id
         self.app_name = app_name
@@ -31,7 +37,357 @@ class ApplePNS(PNS):
         self.voip = voip
         self.key_file = key_file
         self.cert_file = cert_file
-        self.auth_token = auth_token
+        self.provider_token = provider_token
+
+    @property
+    def auth_token(self) -> str:
+        if self.provider_token is None:
+            return None
+        return self.provider_token.token
+
+
+class AppleProviderToken(object):
+    """
+    JWT authenticating the pushes sent with a .p8 signing key, the key
+    is parsed once and the token is signed again before it expires
+    """
+
+    def __init__(self, key_file: str, key_id: str, team_id: str):
+        """
+        :param key_file `str`: path to the .p8 key file
+        :param key_id `str`: id of the key
+        :param team_id `str`: Apple developer team id
+        :raise ValueError: if the key can not be loaded
+        """
+        self.key_id = key_id
+        self.team_id = team_id
+        with open(key_file, 'rb') as f:
+            self.key = load_pem_private_key(f.read(), password=None)
+        self.issued_at = 0
+        self._token = None
+        self.signed = 0
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.issued_at
+
+    @property
+    def token(self) -> str:
+        if self._token is None or self.age >= AppleTokenManager.TOKEN_TTL:
+            self.sign()
+        return self._token
+
+    def sign(self) -> str:
+        self.issued_at = int(time.time())
+        self._token = jwt.encode(payload={'iss': self.team_id, 'iat': self.issued_at},
+                                 key=self.key,
+                                 algorithm='ES256',
+                                 headers={'kid': self.key_id})
+        self.signed += 1
+        return self._token
+
+    def refresh(self, expired_token: str) -> str:
+        """
+        Sign a new token after APNs rejected expired_token,
+        unless it was already replaced
+        """
+        if self._token == expired_token:
+            return self.sign()
+        return self.token
+
+
+class AppleTokenManager(object, metaclass=Singleton):
+    """
+    Provider tokens shared by the apps using the same (team_id, key_id).
+
+    APNs rejects tokens older than one hour and refuses to have them
+    renewed more than every 20 minutes, tokens are signed again in the
+    background after ROTATE_AFTER seconds so pushes never wait for it.
+    """
+
+    ROTATE_AFTER = 40 * 60
+    TOKEN_TTL = 55 * 60
+    CHECK_INTERVAL = 60
+
+    def __init__(self):
+        self.tokens = {}
+        self._task = None
+
+    def get(self, key_file: str, key_id: str, team_id: str) -> AppleProviderToken:
+        """
+        :raise ValueError: if the key can not be loaded
+        """
+        try:
+            return self.tokens[(team_id, key_id)]
+        except KeyError:
+            provider_token = AppleProviderToken(key_file, key_id, team_id)
+            self.tokens[(team_id, key_id)] = provider_token
+            return provider_token
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._rotate())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _rotate(self) -> None:
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            for provider_token in list(self.tokens.values()):
+                if provider_token.age >= self.ROTATE_AFTER:
+                    provider_token.sign()
+
+
+class AppleConnection(object):
+    """
+    A single HTTP/2 connection to APNs, in an AppleConnectionPool.
+
+    The connection is kept open while idle, APNs prefers long lived
+    connections, and ping checks it is still usable.
+    """
+
+    PING_TIMEOUT = 5
+    # httpcore internals ping relies on, checked with the tested httpcore 1.0
+    PING_ATTRIBUTES = ('_h2_state', '_connection_terminated',
+                       '_write_outgoing_data', '_receive_events')
+
+    def __init__(self, base_url: str, ssl_context: ssl.SSLContext):
+        self.base_url = base_url
+        self.ssl_context = ssl_context
+        self.client = self.connect()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    def connect(self) -> AsyncClient:
+        return AsyncClient(http2=True,
+                           base_url=self.base_url,
+                           verify=self.ssl_context,
+                           limits=Limits(max_connections=1,
+                                         max_keepalive_connections=1,
+                                         keepalive_expiry=None))
+
+    @property
+    def http2_connection(self):
+        """
+        The httpcore HTTP/2 connection of the client, None if it is not
+        established or not reachable
+        """
+        try:
+            for connection in self.client._transport._pool.connections:
+                http2_connection = connection._connection
+                if hasattr(http2_connection, '_h2_state'):
+                    return http2_connection
+        except AttributeError:
+            pass
+        return None
+
+    @property
+    def max_streams(self) -> int:
+        """
+        Concurrent streams allowed by APNs on this connection, from the
+        SETTINGS frame it sent, None before the connection is established
+        """
+        http2_connection = self.http2_connection
+        if http2_connection is None:
+            return None
+        return http2_connection._h2_state.remote_settings.max_concurrent_streams
+
+    @property
+    def can_ping(self) -> bool:
+        """
+        Whether the httpcore HTTP/2 connection has what ping needs,
+        None before the connection is established
+        """
+        http2_connection = self.http2_connection
+        if http2_connection is None:
+            return None
+        return all(hasattr(http2_connection, name) for name in self.PING_ATTRIBUTES)
+
+    async def ping(self) -> bool:
+        """
+        Send an HTTP/2 PING over the idle connection and wait for the answer
+        :return: `False` if the connection was closed or APNs sent GOAWAY
+        """
+        http2_connection = self.http2_connection
+        if http2_connection is None:
+            return True
+
+        timeout = {'read': self.PING_TIMEOUT, 'write': self.PING_TIMEOUT}
+        request = httpcore.Request('GET', str(self.client.base_url),
+                                   extensions={'timeout': timeout})
+        try:
+            if http2_connection.is_closed() or not http2_connection.is_available() \
+                    or http2_connection._connection_terminated is not None:
+                return False
+            if not http2_connection.is_idle():
+                return True
+
+            http2_connection._h2_state.ping(os.urandom(8))
+            await http2_connection._write_outgoing_data(request)
+            await http2_connection._receive_events(request)
+            return http2_connection._connection_terminated is None
+        except Exception:
+            return False
+
+    def utilisation(self, default_streams: int) -> float:
+        return self.in_flight / (self.max_streams or default_streams)
+
+    def stats(self, default_streams: int) -> dict:
+        return {'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'max_streams': self.max_streams,
+                'utilisation': round(self.utilisation(default_streams), 3),
+                'requests': self.requests}
+
+
+class AppleConnectionPool(object):
+    """
+    Pool of HTTP/2 connections to APNs for an app.
+
+    Pushes are sent over the least used connection. A new connection is
+    opened when every connection uses more than HIGH_WATER of the streams
+    APNs allows on it, up to max_connections. Connections beyond the first
+    one are closed after IDLE_TIMEOUT seconds without pushes.
+
+    Idle connections are pinged every PING_INTERVAL seconds and replaced
+    when APNs closed them or sent GOAWAY. A push that could not be written
+    on a lost connection is sent again once over a new one, a push lost
+    after it was written is not, APNs may have accepted it.
+    """
+
+    DEFAULT_STREAMS = 100
+    HIGH_WATER = 0.8
+    IDLE_TIMEOUT = 300
+    PING_INTERVAL = 60
+
+    def __init__(self, base_url: str, ssl_context: ssl.SSLContext,
+                 max_connections: int, loggers: dict, name: str):
+        """
+        :param base_url: `str` APNs url, https://host:port
+        :param ssl_context: `ssl.SSLContext` used by the connections
+        :param max_connections: `int` maximum number of connections
+        :param loggers: `dict` global logging instances to write messages (params.loggers)
+        :param name: `str` name of the app, used in logs
+        """
+        self.ssl_context = ssl_context
+        self.max_connections = max_connections
+        self.loggers = loggers
+        self.name = name
+        self.connections = [AppleConnection(base_url, ssl_context)]
+        self.base_url = self.connections[0].client.base_url
+        self.reconnects = 0
+        self.replays = 0
+        self._keepalive_task = None
+
+    async def post(self, path: str, **kwargs):
+        """
+        Send a request over the least used connection
+        :param path: `str` path of the request
+        :param kwargs: arguments for httpx.AsyncClient.post
+        :return: an httpx.Response object
+        """
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+
+        connection = await self._acquire()
+        connection.in_flight += 1
+        connection.requests += 1
+        connection.max_in_flight = max(connection.max_in_flight, connection.in_flight)
+        client = connection.client
+        try:
+            try:
+                return await client.post(path, **kwargs)
+            except WriteError as e:
+                msg = f'{self.name.capitalize()} app: APNs connection lost ({e}), ' \
+                      f'sending {path} again'
+                log_event(loggers=self.loggers, msg=msg, level='info')
+                await self._reconnect(connection, client)
+                self.replays += 1
+                return await connection.client.post(path, **kwargs)
+            except (ReadError, RemoteProtocolError) as e:
+                msg = f'{self.name.capitalize()} app: APNs connection lost ({e}), ' \
+                      f'{path} may have been sent'
+                log_event(loggers=self.loggers, msg=msg, level='info')
+                await self._reconnect(connection, client)
+                raise
+        finally:
+            connection.in_flight -= 1
+            connection.last_used = time.monotonic()
+
+    async def _reconnect(self, connection: AppleConnection, client: AsyncClient) -> None:
+        """
+        Replace the lost client of a connection, unless it was already replaced
+        """
+        if connection.client is not client:
+            return
+        connection.client = connection.connect()
+        self.reconnects += 1
+        await client.aclose()
+
+    async def _keepalive(self) -> None:
+        while True:
+            await asyncio.sleep(self.PING_INTERVAL)
+            try:
+                for connection in list(self.connections):
+                    if connection.in_flight:
+                        continue
+                    if connection.can_ping is False:
+                        msg = f'{self.name.capitalize()} app: APNs keepalive disabled, ' \
+                              f'httpcore {httpcore.__version__} does not support ping'
+                        log_event(loggers=self.loggers, msg=msg, level='warn')
+                        return
+                    client = connection.client
+                    if not await connection.ping():
+                        msg = f'{self.name.capitalize()} app: APNs connection closed, reconnecting'
+                        log_event(loggers=self.loggers, msg=msg, level='deb')
+                        await self._reconnect(connection, client)
+            except Exception as e:
+                msg = f'{self.name.capitalize()} app: APNs keepalive failed: {e}'
+                log_event(loggers=self.loggers, msg=msg, level='error')
+
+    async def _acquire(self) -> AppleConnection:
+        await self._retire_idle()
+
+        connection = min(self.connections,
+                         key=lambda c: c.utilisation(self.DEFAULT_STREAMS))
+        if connection.utilisation(self.DEFAULT_STREAMS) >= self.HIGH_WATER \
+                and len(self.connections) < self.max_connections:
+            connection = AppleConnection(self.connections[0].base_url, self.ssl_context)
+            self.connections.append(connection)
+            msg = f'{self.name.capitalize()} app: opening APNs connection ' \
+                  f'{len(self.connections)} of {self.max_connections}'
+            log_event(loggers=self.loggers, msg=msg, level='deb')
+        return connection
+
+    async def _retire_idle(self) -> None:
+        idle_since = time.monotonic() - self.IDLE_TIMEOUT
+        for connection in self.connections[1:]:
+            if connection.in_flight == 0 and connection.last_used < idle_since:
+                self.connections.remove(connection)
+                await connection.client.aclose()
+                msg = f'{self.name.capitalize()} app: closed idle APNs connection, ' \
+                      f'{len(self.connections)} left'
+                log_event(loggers=self.loggers, msg=msg, level='deb')
+
+    async def aclose(self) -> None:
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        for connection in self.connections:
+            await connection.client.aclose()
+
+    def stats(self) -> dict:
+        return {'max_connections': self.max_connections,
+                'reconnects': self.reconnects,
+                'replays': self.replays,
+                'connections': [connection.stats(self.DEFAULT_STREAMS)
+                                for connection in self.connections]}
 
 
 class AppleConn(ApplePNS):
@@ -41,13 +397,15 @@ class AppleConn(ApplePNS):
 
     def __init__(self, app_id: str, app_name: str, url_push: str,
                  voip: bool, cert_file: str, key_file: str,
-                 apple_pns: PNS, loggers: dict, port: int = 443, auth_token: str = None):
+                 apple_pns: PNS, loggers: dict, port: int = 443,
+                 provider_token: AppleProviderToken = None, max_connections: int = 1):
         """
         :param apple_pns `ApplePNS`: Apple Push Notification Service.
         :param port `int`: 443 or 2197 to allow APNS traffic but block other HTTP traffic.
+        :param max_connections `int`: maximum number of connections opened to APNS.
         :param loggers: `dict` global logging instances to write messages (params.loggers)
         :attribute ssl_context `ssl.SSLContext`: generated with a valid apple certificate.
-        :attribute connection `HTTP20Connection`: related to an app and its corresponding certificate.
+        :attribute connection `AppleConnectionPool`: related to an app and its corresponding certificate.
         """
         self.app_id = app_id
         self.app_name = app_name
@@ -55,10 +413,11 @@ class AppleConn(ApplePNS):
         self.voip = voip
         self.key_file = key_file
         self.cert_file = cert_file
-        self.auth_token = auth_token
+        self.provider_token = provider_token
         self.apple_pns = apple_pns
         self.port = port
         self.loggers = loggers
+        self.max_connections = max_connections
 
     @property
     def ssl_context(self) -> ssl.SSLContext:
@@ -81,20 +440,25 @@ class AppleConn(ApplePNS):
         return ssl_context
 
     @property
-    def connection(self) -> Client:
+    def connection(self) -> AppleConnectionPool:
         """
-        Open an apple connection
+        Open an apple connection pool
         requires a ssl context
 
-        :return: an hyper.http20.connection.HTTP20Connection object
+        The pool is shared by every push sent for the app, requests are
+        multiplexed as HTTP/2 streams without blocking the event loop.
+
+        :return: an AppleConnectionPool object
         """
         host = self.url_push
         port = self.port
         ssl_context = self.ssl_context
 
-        connection = Client(http2=True,
-                            base_url=f'https://{host}:{port}',
-                            verify=ssl_context)
+        connection = AppleConnectionPool(base_url=f'https://{host}:{port}',
+                                         ssl_context=ssl_context,
+                                         max_connections=self.max_connections,
+                                         loggers=self.loggers,
+                                         name=self.app_name)
 
         if self.cert_file:
             cert_file_name = self.cert_file.split('/')[-1]
@@ -120,7 +484,7 @@ class AppleConn(ApplePNS):
 
 
 class AppleRegister(PlatformRegister):
-    TOKEN_TTL = 30 * 60
+    DEFAULT_MAX_CONNECTIONS = 4
 
     def __init__(self, app_id: str, app_name: str, voip: bool,
                  credentials_path: str, config_dict: dict, loggers: dict):
@@ -131,8 +495,6 @@ class AppleRegister(PlatformRegister):
         self.credentials_path = credentials_path
         self.config_dict = config_dict
         self.loggers = loggers
-        self.__issued_at = None
-        self.__auth_token = None
         self.error = ''
 
     @property
@@ -197,7 +559,7 @@ class AppleRegister(PlatformRegister):
                 return
 
     @property
-    def jwt_token(self):
+    def provider_token(self) -> AppleProviderToken:
         try:
             key_file = self.key.get('key_file')
             key_id = self.config_dict['key_id']
@@ -205,21 +567,19 @@ class AppleRegister(PlatformRegister):
         except KeyError:
             return None
 
-        now = time.time()
-
-        with open(key_file, 'r') as f:
-            key = f.read()
-            self.__issued_at = int(now)
-            if not self.__auth_token or self.__issued_at < now - self.TOKEN_TTL:
-                token = jwt.encode(
-                    payload={"iss": team_id, "iat": self.__issued_at},
-                    key=key,
-                    algorithm="ES256",
-                    headers={"kid": key_id}
-                )
-                self.__auth_token = token
-            return self.__auth_token
-        return None
+        try:
+            return AppleTokenManager().get(key_file, key_id, team_id)
+        except (OSError, TypeError, ValueError):
+            self.error = f'{key_file} - bad key file.'
+            return None
+
+    @property
+    def max_connections(self) -> int:
+        try:
+            return int(self.config_dict.get('apple_max_connections', self.DEFAULT_MAX_CONNECTIONS))
+        except ValueError:
+            self.error = 'apple_max_connections must be a number in applications.ini'
+            return None
 
     @property
     def apple_pns(self) -> ApplePNS:
@@ -234,8 +594,9 @@ class AppleRegister(PlatformRegister):
             'cert_file': '',
             'key_file': self.key.get('key_file'),
         }
-        if self.jwt_token:
-            args['auth_token'] = self.jwt_token
+        provider_token = self.provider_token
+        if provider_token:
+            args['provider_token'] = provider_token
         else:
             args['cert_file'] = self.certificate.get('cert_file')
         return ApplePNS(**args)
@@ -252,10 +613,12 @@ class AppleRegister(PlatformRegister):
             'key_file': self.key.get('key_file'),
             'cert_file': '',
             'apple_pns': self.apple_pns,
-            'loggers': self.loggers
+            'loggers': self.loggers,
+            'max_connections': self.max_connections
         }
-        if self.jwt_token:
-            args['auth_token'] = self.jwt_token
+        provider_token = self.provider_token
+        if provider_token:
+            args['provider_token'] = provider_token
         else:
             args['cert_file'] = self.certificate.get('cert_file')
         return AppleConn(**args).connection
@@ -303,11 +666,11 @@ class ApplePushRequest(PushRequest):
 
         self.apple_pns = register['pns']
         self.connection = register['conn']
+        self.breaker = register.get('breaker')
+        self.rate_limiter = register.get('rate_limiter')
         self.path = f'/3/device/{self.token}'
 
-        self.results = self.send_notification()
-
-    def send_notification(self) -> dict:
+    async def send_notification(self) -> dict:
         """
         Send an apple push requests to a single device.
         If status of response is like 5xx,
@@ -336,15 +699,18 @@ class ApplePushRequest(PushRequest):
         status = 500
         reason = ''
         body = {}
+        token_refreshed = False
 
         while counter <= n_retries:
             if self.connection:
                 try:
                     self.log_request(path=log_path)
 
-                    response = self.connection.post(self.path,
-                                                    data=self.payload,
-                                                    headers=self.headers)
+                    started_at = time.monotonic()
+                    response = await self.connection.post(self.path,
+                                                          content=self.payload,
+                                                          headers=self.headers)
+                    self.latency = time.monotonic() - started_at
 
                     if response.status_code != 200:
                         body = response.json()
@@ -352,11 +718,22 @@ class ApplePushRequest(PushRequest):
 
                     status = response.status_code
 
+                    provider_token = self.apple_pns.provider_token
+                    if status == 403 and reason == 'ExpiredProviderToken' \
+                            and provider_token is not None and not token_refreshed:
+                        token_refreshed = True
+                        expired_token = self.headers.get('authorization', '')[len('bearer '):]
+                        self.headers['authorization'] = f'bearer {provider_token.refresh(expired_token)}'
+                        continue
+
                     if status not in status_forcelist:
                         break
 
                 except socket.gaierror:
                     reason = 'socket error'
+                except (ConnectError, ConnectTimeout, PoolTimeout, WriteError) as e:
+                    # the push did not leave, it is safe to send it again
+                    reason = f'connection failed: {e}'
                 except ReadError as e:
                     cause = e.__cause__
                     if "unknown ca" in str(cause).lower():
@@ -364,6 +741,14 @@ class ApplePushRequest(PushRequest):
                         break
                     reason = f'{e}'
                     break
+                except RemoteProtocolError as e:
+                    # APNs may have accepted the push, it is not sent twice
+                    reason = f'connection lost: {e}'
+                    break
+                except HTTPError as e:
+                    # read timeout and the like, APNs may have accepted the push
+                    reason = f'connection lost: {e}'
+                    break
                 except ValueError as err:
                     reason = f'Bad type of object in headers or payload: {err}'
                     break
@@ -371,8 +756,10 @@ class ApplePushRequest(PushRequest):
                 reason = 'no connection'
 
             counter += 1
-            timer = backoff_factor * (2 ** (counter - 1))
-            time.sleep(timer)
+            if counter <= n_retries:
+                if not await self.wait_for_retry(counter, backoff_factor):
+                    status, reason = self.aborted
+                    break
 
         if counter == n_retries:
             reason = 'max retries reached'
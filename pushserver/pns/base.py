@@ -1,11 +1,11 @@
-import concurrent
 import datetime
-import json
-import socket
 
-import requests
-
-from pushserver.resources.utils import log_event
+from pushserver.resources import codec
+from pushserver.resources.calls import CallRegistry
+from pushserver.resources.delivery import priority_class
+from pushserver.resources.remotelog import RemoteLogShipper
+from pushserver.resources.scheduler import RetryCancelled, RetryScheduler
+from pushserver.resources.utils import log_enabled, log_event
 
 
 class PNS(object):
@@ -54,6 +54,21 @@ class PushRequest(object):
         self.wp_request = wp_request
 
     results = {}
+    breaker = None
+    rate_limiter = None
+    aborted = None
+    latency = None
+    device_error = False
+    call_key = None
+
+    @property
+    def payload_text(self) -> str:
+        """
+        Payload as text, payload templates render it as bytes
+        """
+        if isinstance(self.payload, bytes):
+            return self.payload.decode()
+        return self.payload
 
     def retries_params(self, media_type: str) -> tuple:
         if not media_type or media_type == 'sms':
@@ -64,6 +79,54 @@ class PushRequest(object):
 
         return n_tries, bo_factor
 
+    async def wait_for_retry(self, counter: int, backoff_factor: float) -> bool:
+        """
+        Park the push request in the retry scheduler until its next attempt is due.
+        Retries of call wake ups are aborted when the call is cancelled,
+        and retries are aborted while the circuit breaker of the app is open,
+        the breaker only gets the result of the push once it is done.
+        Retries wait for the rate limiter of the app like first attempts.
+        :param counter: `int` number of the retry, starting at 1
+        :param backoff_factor: `float` delay before the first retry (from retries_params)
+        :return: `False` if the push must not be retried, self.aborted has the code and reason
+        """
+        scheduler = RetryScheduler()
+        timer = scheduler.backoff(counter, backoff_factor)
+
+        if log_enabled(self.loggers, 'deb'):
+            msg = f'outgoing {self.platform.title()} request {self.request_id}: ' \
+                  f'retry {counter} in {timer} seconds, {scheduler.pending} retries pending'
+            log_event(loggers=self.loggers, msg=msg, level='deb')
+
+        key = None
+        wp_request = self.wp_request
+        if CallRegistry.is_wake_up(wp_request.event):
+            key = self.call_key or CallRegistry.key(wp_request.sip_to, wp_request.call_id)
+            if CallRegistry().is_cancelled(key):
+                self.aborted = (487, 'call cancelled')
+                return False
+
+        try:
+            await scheduler.wait(timer, key=key)
+        except RetryCancelled:
+            msg = f'outgoing {self.platform.title()} request {self.request_id}: ' \
+                  f'retries aborted, call was cancelled'
+            log_event(loggers=self.loggers, msg=msg, level='info')
+            self.aborted = (487, 'call cancelled')
+            return False
+
+        if self.breaker is not None and self.breaker.is_open:
+            msg = f'outgoing {self.platform.title()} request {self.request_id}: ' \
+                  f'retries aborted, circuit breaker is open'
+            log_event(loggers=self.loggers, msg=msg, level='info')
+            self.aborted = (503, 'upstream unavailable, circuit breaker is open')
+            return False
+
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(priority_class(wp_request.event,
+                                                           wp_request.media_type))
+        return True
+
     def log_request(self, path: str) -> None:
         """
         Write in log information about push notification,
@@ -87,10 +150,13 @@ class PushRequest(object):
         msg = f'outgoing {log_platform} request {self.request_id} to {log_path}'
         log_event(loggers=self.loggers, msg=msg, level=level)
 
+        if not log_enabled(self.loggers, 'deb'):
+            return
+
         msg = f'outgoing {log_platform} request {self.request_id} headers: {self.headers}'
         log_event(loggers=self.loggers, msg=msg, level='deb')
 
-        msg = f'outgoing {log_platform} request {self.request_id} body: {self.payload}'
+        msg = f'outgoing {log_platform} request {self.request_id} body: {self.payload_text}'
         log_event(loggers=self.loggers, msg=msg, level='deb')
 
     def log_error(self):
@@ -100,95 +166,31 @@ class PushRequest(object):
               f"{self.error}"
         log_event(loggers=self.loggers, msg=msg, level=level)
 
-    def server_ip(self, destination):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect((destination, 1))
-            return s.getsockname()[0]
-        except socket.error:
-            return None
-
     def log_remotely(self, body: dict, code: str, reason: str, url: str) -> None:
         """
-        Fork a log of a payload incoming request to a remote url
+        Queue a log of a payload incoming request for the remote urls,
+        it is sent in the background
         :param body: `dict` response to push request
         :param code: `int` of response to push request
         :param reason: `str` of response to push request
         """
 
         push_response = {'code': code, 'description': reason, 'push_url': url}
-        headers = {'Content-Type': 'application/json'}
-        server_ip = self.server_ip('1.2.3.4')
+        shipper = RemoteLogShipper()
         now = datetime.datetime.now()
         timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
         payload = {'request': body, 'response': push_response,
-                   'server_ip': server_ip,'timestamp': timestamp}
+                   'server_ip': shipper.server_ip, 'timestamp': timestamp}
 
         task = 'log remote'
 
-        log_key = self.log_remote.get('log_key')
-        log_time_out = self.log_remote.get('log_time_out')
-
-        results = []
-
         for log_url in self.log_remote['log_urls']:
             msg = f'{task} request {self.request_id} to {log_url}'
             log_event(loggers=self.loggers, msg=msg, level='deb')
-            msg = f'{task} request {self.request_id} to {log_url} headers: {headers}'
-            log_event(loggers=self.loggers, msg=msg, level='deb')
-            msg = f'{task} request {self.request_id} to {log_url} body: {payload}'
-            log_event(loggers=self.loggers, msg=msg, level='deb')
-
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = [
-                    executor.submit(
-                        lambda: requests.post(url=log_url,
-                                              json=payload,
-                                              headers=headers,
-                                              timeout=log_time_out or 2)
-                    )
-                    for log_url in self.log_remote['log_urls']
-                ]
-
-            results = [
-                f.result()
-                for f in futures
-            ]
-        except requests.exceptions.ConnectionError as exc:
-            msg = f'{task} for {self.request_id}: connection error {exc}'
-            log_event(loggers=self.loggers, msg=msg, level='error')
-        except requests.exceptions.ReadTimeout as exc:
-            msg = f'{task} for {self.request_id}: connection error {exc}'
-            log_event(loggers=self.loggers, msg=msg, level='error')
-
-        if not results:
-            return
-
-        for url, result in list(zip(self.log_remote['log_urls'], results)):
-            code = result.status_code
-            text = result.text[:500]
-
-            if log_key:
-                try:
-                    result = result.json()
-                    value = result.get(log_key)
-                except (json.decoder.JSONDecodeError, AttributeError):
-                    value = {}
-
-                if value:
-
-                    msg = f'{task} response for request {self.request_id} from {url} - ' \
-                          f'{code} {log_key}: {value}'
-                    log_event(loggers=self.loggers, msg=msg, level='deb')
-                else:
-                    msg = f'{task} response for request {self.request_id} - ' \
-                          f'code: {code}, key not found'
-                    log_event(loggers=self.loggers, msg=msg, level='error')
-            else:
-                msg = f'{task} response for request {self.request_id} ' \
-                      f'from {url}: {code} {text}'
-                log_event(loggers=self.loggers, msg=msg, level='deb')
+            shipper.submit(log_url, payload, request_id=self.request_id,
+                           log_key=self.log_remote.get('log_remote_key'),
+                           timeout=self.log_remote.get('log_remote_timeout'),
+                           batch_size=self.log_remote.get('log_remote_batch') or 1)
 
     def log_results(self):
         """
@@ -200,10 +202,10 @@ class PushRequest(object):
         url = self.results['url']
 
         level = 'info'
-        body = json.dumps(body)
-        msg = f"outgoing {self.platform.title()} response for request " \
-                f"{self.request_id} body: {body}"
-        log_event(loggers=self.loggers, msg=msg, level='deb')
+        if log_enabled(self.loggers, 'deb'):
+            msg = f"outgoing {self.platform.title()} response for request " \
+                  f"{self.request_id} body: {codec.dumps(body)}"
+            log_event(loggers=self.loggers, msg=msg, level='deb')
 
         if code == 200:
             msg = f"outgoing {self.platform.title()} response for request " \
@@ -216,7 +218,7 @@ class PushRequest(object):
 
         body = {'incoming_body': self.wp_request.__dict__,
                 'outgoing_headers': self.headers,
-                'outgoing_body': self.payload
+                'outgoing_body': self.payload_text
                 }
 
         if self.log_remote.get('log_urls'):
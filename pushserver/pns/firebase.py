@@ -1,22 +1,19 @@
-import json
+import asyncio
 import os
 import time
 from datetime import datetime
+from urllib.parse import urlparse
 
 import oauth2client
-import requests
+from httpx import AsyncClient, HTTPError, Limits
+from oauth2client import transport
+from oauth2client.service_account import ServiceAccountCredentials
+from starlette.concurrency import run_in_threadpool
 
 from pushserver.models.requests import WakeUpRequest
-
-from requests.adapters import HTTPAdapter
-from urllib3 import Retry
-
 from pushserver.pns.base import PNS, PushRequest, PlatformRegister
-from pushserver.resources.utils import log_event, fix_non_serializable_types
-
-#import firebase_admin
-#from firebase_admin import messaging
-#default_app = firebase_admin.initialize_app()
+from pushserver.resources import codec
+from pushserver.resources.utils import log_event
 
 
 class FirebasePNS(PNS):
@@ -42,7 +39,81 @@ class FirebasePNS(PNS):
         self.error = ''
     
 
+class FirebaseCredentials(object):
+    """
+    OAuth2 access token of a Firebase service account.
+
+    The key file is read once. The token is minted in the threadpool, a
+    single refresh being shared by concurrent pushes, and it is renewed in
+    the background REFRESH_AHEAD seconds before it expires, or at once
+    when FCM rejects it.
+    """
+
+    SCOPES = ['https://www.googleapis.com/auth/firebase.messaging']
+    REFRESH_AHEAD = 300
+
+    def __init__(self, auth_file: str, loggers: dict):
+        """
+        :param auth_file: `str` path to the service account json key file
+        :param loggers: `dict` global logging instances to write messages (params.loggers)
+        :raise ValueError: if the key file is not valid
+        """
+        self.auth_file = auth_file
+        self.loggers = loggers
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(auth_file, self.SCOPES)
+        self.access_token = None
+        self.expires_at = 0
+        self.refreshes = 0
+        self._refresh = None
+
+    async def get_token(self) -> str:
+        """
+        :return: `str` a valid access token, or '' if none could be minted
+        """
+        now = time.monotonic()
+        if self.access_token is None or now >= self.expires_at:
+            await self.refresh()
+        elif now >= self.expires_at - self.REFRESH_AHEAD and self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._mint())
+        return self.access_token or ''
+
+    def invalidate(self, access_token: str) -> None:
+        """
+        Drop an access token FCM rejected, unless it was already replaced
+        :param access_token: `str` the rejected token
+        """
+        if access_token and access_token == self.access_token:
+            self.access_token = None
+            self.expires_at = 0
+
+    async def refresh(self) -> None:
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._mint())
+        await asyncio.shield(self._refresh)
+
+    async def _mint(self) -> None:
+        try:
+            token_info = await run_in_threadpool(self._request_token)
+        except Exception as e:
+            msg = f'Cannot generate Firebase access token from {self.auth_file}: {e}'
+            log_event(loggers=self.loggers, msg=msg, level='error')
+        else:
+            self.access_token = token_info.access_token
+            self.expires_at = time.monotonic() + (token_info.expires_in or 0)
+            self.refreshes += 1
+        finally:
+            self._refresh = None
+
+    def _request_token(self):
+        self.credentials.refresh(transport.get_http_object())
+        return self.credentials.get_access_token()
+
+
 class FirebaseRegister(PlatformRegister):
+    DEFAULT_MAX_CONNECTIONS = 10
+    KEEPALIVE_EXPIRY = 120
+    credentials_cache = {}
+
     def __init__(self, app_id: str, app_name: str, voip: bool,
                  config_dict: dict, credentials_path: str, loggers: dict):
 
@@ -107,14 +178,179 @@ class FirebaseRegister(PlatformRegister):
             self.error = pns.error if pns.error else ''
         return pns
 
+    @property
+    def credentials(self) -> FirebaseCredentials:
+        """
+        Credentials of the service account, shared by the apps
+        using the same key file and kept across config reloads
+        while the key file is not modified
+        """
+        if not self.auth_file:
+            return None
+        try:
+            key = (self.auth_file, os.stat(self.auth_file).st_mtime)
+        except OSError as e:
+            self.error = f'{self.auth_file} - bad service account file: {e}'
+            return None
+        try:
+            return self.credentials_cache[key]
+        except KeyError:
+            pass
+        try:
+            credentials = FirebaseCredentials(self.auth_file, self.loggers)
+        except (OSError, KeyError, ValueError) as e:
+            self.error = f'{self.auth_file} - bad service account file: {e}'
+            return None
+        for cached_key in [cached_key for cached_key in self.credentials_cache if cached_key[0] == self.auth_file]:
+            del self.credentials_cache[cached_key]
+        self.credentials_cache[key] = credentials
+        return credentials
+
+    @property
+    def max_connections(self) -> int:
+        try:
+            return int(self.config_dict.get('firebase_max_connections', self.DEFAULT_MAX_CONNECTIONS))
+        except ValueError:
+            self.error = 'firebase_max_connections must be a number in applications.ini'
+            return None
+
+    @property
+    def firebase_conn(self) -> AsyncClient:
+        """
+        Open a pool of keep-alive HTTP/2 connections to the FCM project,
+        shared by every push sent for the app.
+
+        :return: an httpx.AsyncClient object
+        """
+        max_connections = self.max_connections
+        if self.error:
+            return
+
+        limits = Limits(max_connections=max_connections,
+                        max_keepalive_connections=max_connections,
+                        keepalive_expiry=self.KEEPALIVE_EXPIRY)
+        connection = AsyncClient(http2=True, limits=limits)
+
+        host = urlparse(self.url_push).netloc
+        msg = f'{self.app_name.capitalize()} app: Connecting to {host} ' \
+              f'using up to {max_connections} connections'
+        log_event(loggers=self.loggers, msg=msg, level='deb')
+
+        return connection
+
     @property
     def register_entries(self):
         if self.error:
             return {}
 
-        return {'pns': self.pns,
+        pns = self.pns
+        credentials = self.credentials
+        connection = self.firebase_conn
+        if self.error:
+            return {}
+
+        return {'pns': pns,
+                'conn': connection,
                 'auth_key': self.auth_key,
-                'auth_file': self.auth_file}
+                'auth_file': self.auth_file,
+                'credentials': credentials}
+
+
+class FirebaseResponse(object):
+    """
+    Outcome of a push, from a FCM HTTP v1 or legacy API response.
+
+    The response content is parsed once, the outcome is one of delivered,
+    unregistered (the token is not valid anymore, code 410), retryable or
+    fatal. body keeps the status, reason and content of the response.
+    """
+
+    RETRYABLE_ERRORS = ('UNAVAILABLE', 'INTERNAL', 'QUOTA_EXCEEDED',
+                        'Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded')
+    UNREGISTERED_ERRORS = ('UNREGISTERED', 'NotRegistered', 'InvalidRegistration')
+    DEVICE_ERRORS = ('QUOTA_EXCEEDED', 'DeviceMessageRateExceeded')
+
+    __slots__ = ('code', 'outcome', 'description', 'body', 'error')
+
+    def __init__(self, status_code: int, content: bytes, reason_phrase: str = ''):
+        """
+        :param status_code: `int` HTTP status of the response
+        :param content: `bytes` content of the response
+        :param reason_phrase: `str` HTTP reason phrase of the response
+        """
+        self.code = status_code
+        self.error = None
+        self.body = {'status_code': status_code}
+        if reason_phrase:
+            self.body['reason'] = reason_phrase
+
+        data = None
+        if content:
+            try:
+                data = codec.loads(content)
+            except codec.DecodeError:
+                data = content.decode(errors='replace')
+            self.body['_content'] = data
+
+        if status_code == 200:
+            self._classify_success(data)
+        else:
+            self._classify_error(status_code, data, reason_phrase)
+
+    @property
+    def retryable(self) -> bool:
+        return self.outcome == 'retryable'
+
+    @property
+    def device_error(self) -> bool:
+        """
+        The push failed because of its device, not because of FCM
+        """
+        return self.code == 429 or self.error in self.DEVICE_ERRORS
+
+    def _classify_success(self, data) -> None:
+        results = data.get('results') if isinstance(data, dict) and data.get('failure') else None
+        if not results or not isinstance(results[0], dict):
+            self.outcome, self.description = 'delivered', 'OK'
+            return
+
+        # legacy API, the error of the message is in the results
+        error = results[0].get('error') or 'unknown failure reason'
+        self.description = self.error = error
+        if error in self.RETRYABLE_ERRORS:
+            self.outcome, self.code = 'retryable', 503
+        elif error in self.UNREGISTERED_ERRORS:
+            self.outcome, self.code = 'unregistered', 410
+        else:
+            self.outcome, self.code = 'fatal', 400
+
+    def _classify_error(self, status_code: int, data, reason_phrase: str) -> None:
+        error = data.get('error') if isinstance(data, dict) else None
+        details = internal_code = error_code = None
+        if isinstance(error, dict):
+            details = error.get('message')
+            internal_code = error.get('code')
+            error_code = error.get('status')
+            for detail in error.get('details') or ():
+                if isinstance(detail, dict) and detail.get('errorCode'):
+                    error_code = detail['errorCode']
+                    break
+        elif isinstance(error, str):
+            details = error
+        self.error = error_code
+
+        if reason_phrase and details:
+            self.description = f'{reason_phrase} {details}'
+        else:
+            self.description = reason_phrase or details or 'unknown failure reason'
+
+        if error_code in self.UNREGISTERED_ERRORS or internal_code == 404 or \
+                (internal_code == 400 and details and 'not a valid FCM registration token' in details):
+            self.outcome, self.code = 'unregistered', 410
+        elif status_code >= 500 or status_code == 429 or error_code in self.RETRYABLE_ERRORS:
+            self.outcome = 'retryable'
+        else:
+            self.outcome = 'fatal'
 
 
 class FirebasePushRequest(PushRequest):
@@ -149,49 +385,20 @@ class FirebasePushRequest(PushRequest):
         self.log_remote = log_remote
 
         self.pns = register['pns']
+        self.connection = register['conn']
+        self.breaker = register.get('breaker')
+        self.rate_limiter = register.get('rate_limiter')
+        self.credentials = register.get('credentials')
 
         self.path = self.pns.url_push
-        self.results = self.send_http_notification()
-        # self.results = self.send_fcm_notification()
 
-    def requests_retry_session(self, counter=0):
-        """
-        Define parameters to retry a push notification
-        according to media_type.
-        :param counter: `int` (optional) if retries was necessary
-        because of connection fails
-
-        Following rfc3261 specification, an exponential backoff factor is used.
-        More specifically:
-        backoff = 0.5
-        T1 = 500ms
-        max_retries_call = 7
-        time_to_live_call = 64 seconds
-        max_retries_sms = 11
-        time_to_live_sms ~ 2 hours
-        """
+    async def send_notification(self) -> dict:
+        return await self.send_http_notification()
 
-        retries = self.retries_params[self.media_type] - counter
-        backoff_factor = self.retries_params['bo_factor'] * 0.5 * 2 ** counter
-
-        status_forcelist = tuple([status for status in range(500, 600)])
-        session = None
-
-        session = session or requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
-    def send_http_notification(self) -> dict:
+    async def send_http_notification(self) -> dict:
         """
-        Send a Firebase push notification over HTTP
+        Send a Firebase push notification over HTTP/2,
+        using the connection pool of the application.
         """
 
         if self.error:
@@ -201,109 +408,56 @@ class FirebasePushRequest(PushRequest):
         n_retries, backoff_factor = self.retries_params(self.wp_request.media_type)
 
         counter = 0
-        error = False
-        code = 500
-        reason = ""
-        body = None
-        response = None
-        
+        reason = ''
+        fcm_response = None
+        token_refreshed = False
+
         while counter <= n_retries:
             self.log_request(path=self.pns.url_push)
             try:
-                response = requests.post(self.pns.url_push,
-                                         self.payload,
-                                         headers=self.headers)
-                break
-            except requests.exceptions.RequestException as e:
-                error = True
+                started_at = time.monotonic()
+                response = await self.connection.post(self.pns.url_push,
+                                                      content=self.payload,
+                                                      headers=self.headers)
+                self.latency = time.monotonic() - started_at
+            except HTTPError as e:
+                fcm_response = None
                 reason = f'connection failed: {e}'
-                counter += 1
-                timer = backoff_factor * (2 ** (counter - 1))
-                time.sleep(timer)
-
-        if counter == n_retries:
-            reason = "maximum retries reached"
-
-        elif error:
-            try:
-                response = self.requests_retry_session(counter). \
-                    post(self.pns.url_push,
-                         self.payload,
-                         headers=self.headers)
-            except Exception as x:
-                level = 'error'
-                msg = f"outgoing {self.platform.title()} response for " \
-                      f"{self.request_id}, push failed: " \
-                      f"an error occurred in {x.__class__.__name__}"
-                log_event(loggers=self.loggers, msg=msg, level=level)
-        try:
-            body = response.__dict__
-        except (TypeError, ValueError):
+            else:
+                fcm_response = FirebaseResponse(response.status_code, response.content,
+                                                response.reason_phrase)
+                if fcm_response.code == 401 and self.credentials is not None and not token_refreshed:
+                    # the access token was revoked or expired early, mint a new one once
+                    token_refreshed = True
+                    expired_token = self.headers.get('Authorization', '')[len('Bearer '):]
+                    self.credentials.invalidate(expired_token)
+                    self.headers['Authorization'] = f'Bearer {await self.credentials.get_token()}'
+                    continue
+                if not fcm_response.retryable:
+                    break
+                reason = fcm_response.description
+
+            counter += 1
+            if counter <= n_retries:
+                if not await self.wait_for_retry(counter, backoff_factor):
+                    break
+
+        if self.aborted:
+            code, description = self.aborted
+            body = {'reason': description}
+        elif fcm_response is None:
             code = 500
-            reason = 'cannot parse response body'
-            body = {}
+            description = 'maximum retries reached'
+            body = {'reason': description}
+            level = 'error'
+            msg = f"outgoing {self.platform.title()} response for " \
+                  f"{self.request_id}, push failed: {reason}"
+            log_event(loggers=self.loggers, msg=msg, level=level)
         else:
-            reason = body.get('reason')
-            code = response.status_code
-
-        for k in ('raw', 'request', 'connection', 'cookies', 'elapsed'):
-            try:
-                del body[k]
-            except KeyError:
-                pass
-            except TypeError:
-                break
-
-        body = json.dumps(fix_non_serializable_types(body))
-
-        if isinstance(body, str):
-            body = json.loads(body)
-        
-        if code == 200:
-            description = 'OK'
-            try:
-                failure = body['_content']['failure']
-            except KeyError:
-                pass
-            else:
-                if failure == 1:
-                    description = body['_content']['results'][0]['error']
-                    code = 410
-                    
-        else:
-            try:
-                reason = body['reason']
-            except KeyError:
-                reason = None
-            
-            try:
-                details = body['_content']['error']['message']
-            except KeyError:
-                details = None
-               
-            try:
-                internal_code = body['_content']['error']['code']
-            except KeyError:
-                internal_code = None
-            
-            if internal_code == 400 and 'not a valid FCM registration token' in details:
-                code = 410
-            elif internal_code == 404:
-                code = 410
-
-            if reason and details:
-                description = "%s %s" % (reason, details)
-            elif reason:
-                description = reason
-            elif details:
-                error_description = details
-            else:
-                description = 'unknown failure reason'
-                
-        keys = list(body.keys())
-        for key in keys:
-            if not body[key]:
-                del body[key]
+            code = fcm_response.code
+            description = fcm_response.description
+            body = fcm_response.body
+            self.device_error = fcm_response.device_error
 
         results = {'body': body,
                    'code': code,
@@ -317,65 +471,3 @@ class FirebasePushRequest(PushRequest):
         self.results = results
         self.log_results()
         return results
-
-    def send_fcm_notification(self) -> dict:
-        """
-        Send a native Firebase push notification
-        """
-
-        if self.error:
-            self.log_error()
-            return {'code': 500, 'body': {}, 'reason': 'Internal server error'}
-
-        n_retries, backoff_factor = self.retries_params(self.wp_request.media_type)
-
-        counter = 0
-        error = False
-        code = 200
-        response = None
-        body = None
-        reason = None
-        
-        while counter <= n_retries:
-            self.log_request(path=self.pns.url_push)
-
-            try:
-                response = messaging.send(self.payload['fcm'])
-                break
-            except Exception as e:
-                error = True
-                response = f'connection failed: {e}'
-                counter += 1
-                timer = backoff_factor * (2 ** (counter - 1))
-                conde = 500
-                time.sleep(timer)
-
-        if counter == n_retries:
-            reason = "maximum retries reached"
-
-        elif error:
-            try:
-                response = self.requests_retry_session(counter). \
-                    post(self.pns.url_push,
-                         self.payload,
-                         headers=self.headers)
-            except Exception as x:
-                level = 'error'
-                msg = f"outgoing {self.platform.title()} response for " \
-                      f"{self.request_id}, push failed: " \
-                      f"an error occurred in {x.__class__.__name__}"
-                log_event(loggers=self.loggers, msg=msg, level=level)
-
-        body = {'response': response}
-        results = {'body': body,
-                   'code': code,
-                   'reason': reason,
-                   'url': self.pns.url_push,
-                   'platform': 'firebase',
-                   'call_id': self.wp_request.call_id,
-                   'token': self.token
-                   }
-
-        self.results = results
-        self.log_results()
-        return results
@@ -1,8 +1,12 @@
+import asyncio
 import configparser
 import importlib
 import os
 import sys
 
+from pushserver.resources.breaker import CircuitBreaker
+from pushserver.resources.templates import compile_payload_templates
+from pushserver.resources.throttle import TokenBucket
 from pushserver.resources.utils import log_event
 
 
@@ -112,6 +116,31 @@ def check_pns_classes(platform: str, extra_dir: str) -> tuple:
     return error, register_class
 
 
+async def close_pns_connections(pns_register: dict) -> None:
+    """
+    Close the async clients opened by the platform registers
+    :param pns_register: `dict` with the registered applications (params.pns_register)
+    """
+    for register_entries in pns_register.values():
+        for entry in register_entries.values():
+            aclose = getattr(entry, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+
+async def close_replaced_pns_connections(pns_register: dict, wait_for: float = 5) -> None:
+    """
+    Close the async clients of a register replaced by a configuration reload,
+    once the pushes that started with it are done
+    :param pns_register: `dict` with the replaced applications
+    :param wait_for: `float` seconds between checks for pushes being sent
+    """
+    await asyncio.sleep(wait_for)
+    while any(entries.get('pushes') for entries in pns_register.values()):
+        await asyncio.sleep(wait_for)
+    await close_pns_connections(pns_register)
+
+
 def get_pns_from_config(config_path: str, credentials: str, apps_extra_dir: str,
                         pns_extra_dir: str, loggers: dict) -> dict:
     """
@@ -129,7 +158,10 @@ def get_pns_from_config(config_path: str, credentials: str, apps_extra_dir: str,
     #                                    'headers_class': headers_class,
     #                                    'payload_class': payload_class,
     #                                    'pns': ApplePNS,
-    #                                    'conn': AppleConn}
+    #                                    'conn': AppleConn,
+    #                                    'rate_limiter': TokenBucket or None,
+    #                                    'breaker': CircuitBreaker or None,
+    #                                    'pushes': int, pushes being sent}
     #             (<app_id>, 'firebase'): {'id': str,
     #                                     'name': str,
     #                                    'headers_class': headers_class,
@@ -145,26 +177,62 @@ def get_pns_from_config(config_path: str, credentials: str, apps_extra_dir: str,
         name = config[id]['app_type'].lower()
         platform = config[id]['app_platform'].lower()
         voip = config[id].get('voip')
-        error, log, log_urls, log_key, log_timeout = '', False, '', '', None
+        error, log, log_urls, log_key, log_timeout, log_batch = '', False, '', '', None, 1
         try:
             log_urls_str = config[id]['log_remote_urls']
-            log_urls = set(log_urls_str.split(','))
-            log_key = config[id].get('log_key')
-            log_timeout = config[id].get('log_time_out')
-            log_timeout = int(log_timeout) if log_timeout else None
+            log_urls = set(url.strip() for url in log_urls_str.split(',') if url.strip())
+            log_key = config[id].get('log_remote_key', config[id].get('log_key'))
+            log_timeout = config[id].get('log_remote_timeout', config[id].get('log_time_out'))
+            log_timeout = float(log_timeout) if log_timeout else None
+            log_batch = int(config[id].get('log_remote_batch', 1))
         except KeyError:
             log = False
-        except SyntaxError:
+        except (SyntaxError, ValueError):
             error = f'log_remote_urls = {log_urls_str} - bad syntax'
             log = False
         log_remote = {'error': error,
                       'log_urls': log_urls,
                       'log_remote_key': log_key,
-                      'log_remote_timeout': log_timeout}
+                      'log_remote_timeout': log_timeout,
+                      'log_remote_batch': max(log_batch, 1)}
 
         if voip:
             voip = True if voip.lower() == 'true' else False
 
+        rate_limit = config[id].get('rate_limit')
+        rate_burst = config[id].get('rate_burst')
+        rate_limiter = None
+        if rate_limit:
+            try:
+                rate_limiter = TokenBucket(rate=float(rate_limit),
+                                           burst=int(rate_burst) if rate_burst else None)
+            except ValueError:
+                reason = f'rate_limit = {rate_limit}, rate_burst = {rate_burst} - bad value'
+                invalid_apps[(app_id, platform)] = {'name': name, 'reason': reason}
+                continue
+
+        breaker = None
+        breaker_error_rate = config[id].get('breaker_error_rate', '0')
+        try:
+            if float(breaker_error_rate) > 0:
+                breaker_latency = config[id].get('breaker_latency')
+                breaker = CircuitBreaker(name=f'{name.capitalize()} app {app_id} {platform}',
+                                         error_rate=float(breaker_error_rate),
+                                         latency=float(breaker_latency) if breaker_latency else None,
+                                         window=int(config[id].get('breaker_window', CircuitBreaker.WINDOW)),
+                                         open_time=float(config[id].get('breaker_open_time',
+                                                                        CircuitBreaker.OPEN_TIME)))
+        except ValueError:
+            reason = 'breaker_error_rate, breaker_latency, breaker_window or breaker_open_time - bad value'
+            invalid_apps[(app_id, platform)] = {'name': name, 'reason': reason}
+            continue
+
+        try:
+            payload_templates = compile_payload_templates(config[id], platform)
+        except ValueError as e:
+            invalid_apps[(app_id, platform)] = {'name': name, 'reason': str(e)}
+            continue
+
         error, register_class = check_pns_classes(platform=platform, extra_dir=pns_extra_dir)
 
         if error:
@@ -202,7 +270,12 @@ def get_pns_from_config(config_path: str, credentials: str, apps_extra_dir: str,
                                             'name': name,
                                             'headers_class': headers_class,
                                             'payload_class': payload_class,
-                                            'log_remote': log_remote}
+                                            'log_remote': log_remote,
+                                            'rate_limiter': rate_limiter,
+                                            'breaker': breaker,
+                                            'headers_cache': {},
+                                            'payload_templates': payload_templates,
+                                            'pushes': 0}
 
         for k, v in register_entries.items():
             pns_register[(app_id, platform)][k] = v
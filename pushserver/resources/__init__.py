@@ -1 +1 @@
-__all__ = ['notification', 'pns',  'settings', 'utils', 'storage']
+__all__ = ['breaker', 'calls', 'codec', 'dedup', 'delivery', 'logs', 'metrics', 'notification', 'pns', 'remotelog', 'scheduler', 'settings', 'utils', 'storage', 'templates']
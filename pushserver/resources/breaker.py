@@ -0,0 +1,154 @@
+import time
+from collections import deque
+
+from pushserver.resources import settings
+from pushserver.resources.utils import log_event
+
+__all__ = ['CircuitBreaker']
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending pushes to the upstream of an application while it fails.
+
+    The breaker opens when the share of failed (or slower than latency)
+    results in the last window results reaches error_rate. While open, new
+    pushes and pending retries fail fast. After open_time seconds it is half
+    open and lets probes pushes through: a success closes it, a failure
+    opens it again. Every push let through by allow must be recorded or
+    released, a probe not done after probe_timeout seconds no longer
+    holds its place.
+    """
+
+    ERROR_RATE = 0.5
+    WINDOW = 20
+    MIN_RESULTS = 10
+    OPEN_TIME = 30
+    PROBES = 1
+    PROBE_TIMEOUT = 30
+
+    def __init__(self, name: str, error_rate: float = ERROR_RATE, latency: float = None,
+                 window: int = WINDOW, open_time: float = OPEN_TIME, probes: int = PROBES,
+                 probe_timeout: float = PROBE_TIMEOUT):
+        """
+        :param name: `str` name of the upstream, used in logs
+        :param error_rate: `float` share of failures, between 0 and 1, opening the breaker
+        :param latency: `float` (optional) seconds after which a push counts as a failure
+        :param window: `int` number of recent results considered
+        :param open_time: `float` seconds before an open breaker lets probes through
+        :param probes: `int` pushes let through while half open
+        :param probe_timeout: `float` seconds after which a probe is given up
+        """
+        if not 0 < error_rate <= 1 or window <= 0 or open_time < 0 or probes <= 0 \
+                or probe_timeout <= 0:
+            raise ValueError('bad circuit breaker settings')
+        self.name = name
+        self.error_rate = error_rate
+        self.latency = latency
+        self.window = window
+        self.min_results = min(self.MIN_RESULTS, window)
+        self.open_time = open_time
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+
+        self.state = 'closed'
+        self.opened_at = None
+        self._probes = deque()
+        self.opened = 0
+        self.rejected = 0
+        self._results = deque(maxlen=window)
+
+    def allow(self) -> bool:
+        """
+        Check if a push can be sent to the upstream
+        """
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.open_time:
+                self.rejected += 1
+                return False
+            self._set_state('half-open')
+
+        if self.state == 'half-open':
+            now = time.monotonic()
+            while self._probes and self._probes[0] + self.probe_timeout <= now:
+                self._probes.popleft()
+            if len(self._probes) >= self.probes:
+                self.rejected += 1
+                return False
+            self._probes.append(now)
+
+        return True
+
+    @property
+    def probes_in_flight(self) -> int:
+        return len(self._probes)
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Check if the breaker rejects pushes, without taking a probe
+        """
+        return self.state == 'open' and time.monotonic() - self.opened_at < self.open_time
+
+    def release(self) -> None:
+        """
+        Give back a push let through by allow without a result, as a
+        cancelled push
+        """
+        if self.state == 'half-open' and self._probes:
+            self._probes.popleft()
+
+    def record(self, success: bool, latency: float = None) -> None:
+        """
+        Record the result of a push sent to the upstream
+        :param success: `bool` False if the upstream failed
+        :param latency: `float` (optional) seconds the last attempt of the push took
+        """
+        if success and self.latency and latency is not None and latency > self.latency:
+            success = False
+
+        if self.state == 'half-open':
+            if success:
+                self._set_state('closed')
+            else:
+                self._open()
+            return
+
+        if self.state == 'open':
+            return
+
+        self._results.append(success)
+        if len(self._results) < self.min_results:
+            return
+        failures = self._results.count(False)
+        if failures / len(self._results) >= self.error_rate:
+            self._open()
+
+    def reset(self) -> None:
+        self._set_state('closed')
+
+    def _open(self) -> None:
+        self.opened += 1
+        self.opened_at = time.monotonic()
+        self._set_state('open')
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        self._probes.clear()
+        if state == 'closed':
+            self._results.clear()
+            self.opened_at = None
+
+        level = 'warn' if state == 'open' else 'info'
+        msg = f'{self.name} circuit breaker is {state}'
+        log_event(loggers=settings.params.loggers, msg=msg, level=level)
+
+    def stats(self) -> dict:
+        failures = self._results.count(False)
+        return {'state': self.state,
+                'error_rate': round(failures / len(self._results), 3) if self._results else 0.0,
+                'results': len(self._results),
+                'opened': self.opened,
+                'rejected': self.rejected}
@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict, defaultdict
+
+from application.python.types import Singleton
+
+from pushserver.resources import settings
+from pushserver.resources.scheduler import RetryScheduler
+from pushserver.resources.utils import log_event
+
+__all__ = ['CallRegistry', 'WAKE_UP_EVENTS']
+
+
+WAKE_UP_EVENTS = ('incoming_session', 'incoming_conference_request')
+
+
+class CallRegistry(object, metaclass=Singleton):
+    """
+    Wake up deliveries by account and call_id.
+
+    A cancel for a call of an account aborts the pending retries of its wake
+    ups, and wake ups still queued, or arriving after the cancel, are dropped
+    before they are sent. Wake ups of other accounts with the same call_id
+    (forked or conference invites) are not affected. Cancelled calls are
+    remembered for CANCEL_TTL seconds.
+    """
+
+    CANCEL_TTL = 300
+    MAX_CANCELLED = 10000
+
+    def __init__(self):
+        self.in_flight = defaultdict(int)
+        self._cancelled = OrderedDict()
+        self.dropped = 0
+        self.aborted = 0
+
+    @staticmethod
+    def is_wake_up(event: str) -> bool:
+        return event in WAKE_UP_EVENTS
+
+    @staticmethod
+    def key(account: str, call_id: str) -> tuple:
+        """
+        Key of the wake ups of a call, also used for their pending retries
+        :param account: `str` account woken up, the path account for API
+        version 2, the called SIP URI (to) for version 1
+        :param call_id: `str` call id
+        """
+        return account, call_id
+
+    def start(self, key: tuple) -> None:
+        self.in_flight[key] += 1
+
+    def finish(self, key: tuple) -> None:
+        self.in_flight[key] -= 1
+        if self.in_flight[key] <= 0:
+            del self.in_flight[key]
+
+    def is_cancelled(self, key: tuple) -> bool:
+        self._expire()
+        return key in self._cancelled
+
+    def cancel(self, key: tuple) -> int:
+        """
+        Record a cancel and abort the pending retries of the call wake ups
+        :param key: `tuple` account and call id of the cancel request (see key)
+        :return: `int` number of aborted retries
+        """
+        self._expire()
+        self._cancelled[key] = time.monotonic()
+        self._cancelled.move_to_end(key)
+        while len(self._cancelled) > self.MAX_CANCELLED:
+            self._cancelled.popitem(last=False)
+
+        aborted = RetryScheduler().cancel(key)
+        self.aborted += aborted
+        if aborted:
+            msg = f'cancel for call {key[1]} of {key[0]} aborted {aborted} pending wake up retries'
+            log_event(loggers=settings.params.loggers, msg=msg, level='info')
+        return aborted
+
+    def drop(self, key: tuple, request_id: str) -> None:
+        """
+        Count a wake up that is not sent because its call was cancelled
+        """
+        self.dropped += 1
+        msg = f'{request_id} not sent, call {key[1]} of {key[0]} was cancelled'
+        log_event(loggers=settings.params.loggers, msg=msg, level='info')
+
+    def _expire(self) -> None:
+        expired_at = time.monotonic() - self.CANCEL_TTL
+        while self._cancelled:
+            key, cancelled_at = next(iter(self._cancelled.items()))
+            if cancelled_at > expired_at:
+                break
+            del self._cancelled[key]
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self.in_flight),
+                'cancelled': len(self._cancelled),
+                'suppressed': {'dropped': self.dropped,
+                               'aborted_retries': self.aborted}}
@@ -0,0 +1,81 @@
+import json
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ['backend', 'DecodeError', 'dumpb', 'dumps', 'loads', 'JSONResponse']
+
+
+# JSON encoding and decoding for payloads, responses and logs.
+# orjson is used when it is installed, json otherwise. Both produce valid
+# JSON but not the same bytes: orjson is compact and does not escape
+# non ASCII characters.
+
+DecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    backend = 'orjson'
+
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj) -> bytes:
+        """
+        :param obj: object to encode
+        :return: `bytes` JSON document
+        :raise TypeError: if obj can not be encoded
+        """
+        return orjson.dumps(obj, option=_OPTIONS)
+
+    def dumps(obj) -> str:
+        """
+        :param obj: object to encode
+        :return: `str` JSON document
+        :raise TypeError: if obj can not be encoded
+        """
+        return orjson.dumps(obj, option=_OPTIONS).decode()
+
+    def loads(data):
+        """
+        :param data: `str` or `bytes` JSON document
+        :raise DecodeError: if data is not valid JSON
+        """
+        return orjson.loads(data)
+
+else:
+    backend = 'json'
+
+    def dumpb(obj) -> bytes:
+        """
+        :param obj: object to encode
+        :return: `bytes` JSON document
+        :raise TypeError: if obj can not be encoded
+        """
+        return json.dumps(obj).encode()
+
+    def dumps(obj) -> str:
+        """
+        :param obj: object to encode
+        :return: `str` JSON document
+        :raise TypeError: if obj can not be encoded
+        """
+        return json.dumps(obj)
+
+    def loads(data):
+        """
+        :param data: `str` or `bytes` JSON document
+        :raise DecodeError: if data is not valid JSON
+        """
+        return json.loads(data)
+
+
+class JSONResponse(StarletteJSONResponse):
+    """
+    JSON response encoded with the codec backend
+    """
+
+    def render(self, content) -> bytes:
+        return dumpb(content)
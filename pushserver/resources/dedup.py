@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from application.python.types import Singleton
+from starlette.responses import Response
+
+from pushserver.resources import settings
+from pushserver.resources.utils import log_event
+
+__all__ = ['RequestCache']
+
+
+class RequestCache(object, metaclass=Singleton):
+    """
+    Responses of the push requests received in the last dedup_window seconds.
+
+    A request received again while the first one is in progress waits for
+    its response, a request received again later gets the same response,
+    without sending another push. At most dedup_size requests are kept,
+    the least recently used are evicted first. Server errors are not kept
+    so the client can retry.
+    """
+
+    def __init__(self):
+        self.window = settings.params.dedup_window
+        self.size = settings.params.dedup_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.attached = 0
+
+    async def run(self, key: tuple, func, *args, **kwargs) -> Response:
+        """
+        Return the response of func, or the response of a previous call with the same key
+        :param key: `tuple` identifying the push request
+        :param func: coroutine function returning the response of the request
+        """
+        if self.window <= 0 or self.size <= 0:
+            return await func(*args, **kwargs)
+
+        future = self._lookup(key)
+        if future is not None:
+            if future.done():
+                self.hits += 1
+            else:
+                self.attached += 1
+            action = 'returning' if future.done() else 'waiting for'
+            msg = f'duplicate request {key}, {action} the first response'
+            log_event(loggers=settings.params.loggers, msg=msg, level='deb')
+
+            status_code, body, media_type = await asyncio.shield(future)
+            return Response(content=body, status_code=status_code, media_type=media_type)
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (time.monotonic(), future)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+        try:
+            response = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            self._discard(key, future)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            self._discard(key, future)
+            raise
+
+        future.set_result((response.status_code, response.body, response.media_type))
+        if response.status_code >= 500:
+            self._discard(key, future)
+        return response
+
+    def _lookup(self, key: tuple):
+        expired_at = time.monotonic() - self.window
+        while self._entries:
+            created_at, future = next(iter(self._entries.values()))
+            if created_at > expired_at:
+                break
+            self._entries.popitem(last=False)
+
+        try:
+            created_at, future = self._entries[key]
+        except KeyError:
+            return None
+        if created_at <= expired_at:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return future
+
+    def _discard(self, key: tuple, future) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is future:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'attached': self.attached}
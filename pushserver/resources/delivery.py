@@ -0,0 +1,124 @@
+import asyncio
+import itertools
+import time
+from collections import defaultdict
+
+from application.python.types import Singleton
+
+from pushserver.resources import settings
+from pushserver.resources.metrics import LatencyStats
+from pushserver.resources.utils import log_event
+
+__all__ = ['DeliveryQueue', 'PRIORITY_CLASSES', 'priority_class']
+
+
+# Ordered from the highest priority, a phone rings only for a short time
+# so call wake ups are always dispatched before message traffic
+PRIORITY_CLASSES = ('call', 'message', 'bulk')
+
+
+def priority_class(event: str, media_type: str) -> str:
+    """
+    Priority class of a push notification
+    :param event: `str` event of the wake up request
+    :param media_type: `str` media type of the wake up request
+    :return: a `str` from PRIORITY_CLASSES
+    """
+    if event in ('incoming_session', 'incoming_conference_request', 'cancel'):
+        return 'call'
+    if event == 'message' and media_type != 'file-transfer':
+        return 'message'
+    return 'bulk'
+
+
+class DeliveryQueue(object, metaclass=Singleton):
+    """
+    Bounded queue of push deliveries consumed by a dedicated pool of workers,
+    used when the server replies before the push is sent (return_async = false).
+
+    Deliveries are dispatched by strict priority class, in submission order
+    within a class. A class is only queued while the queue is below its
+    DEPTH_SHARE of the maximum depth, so message and bulk traffic can not
+    fill the room kept for call wake ups. submit raises asyncio.QueueFull
+    when the queue reached the depth of the class.
+    """
+
+    DEPTH_SHARE = {'call': 1.0, 'message': 0.8, 'bulk': 0.6}
+
+    def __init__(self):
+        self.workers = settings.params.delivery_workers
+        self.max_depth = settings.params.delivery_queue_size
+        self.wait_time = {name: LatencyStats() for name in PRIORITY_CLASSES}
+        self.queued = defaultdict(int)
+        self.rejected_by_class = defaultdict(int)
+        self.busy = 0
+        self.rejected = 0
+        self._queue = None
+        self._tasks = []
+        self._sequence = itertools.count()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self) -> None:
+        if self._queue is not None:
+            return
+        # bounded by submit, per priority class
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+        msg = f'Delivery queue started with {self.workers} workers ' \
+              f'and a maximum depth of {self.max_depth}'
+        log_event(loggers=settings.params.loggers, msg=msg, level='deb')
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, func, priority: str = 'bulk', **kwargs) -> None:
+        """
+        Queue a delivery
+        :param func: coroutine function that sends the push notification(s)
+        :param priority: `str` priority class of the delivery (see priority_class)
+        :param kwargs: arguments for func
+        """
+        self.start()
+        if self.depth >= max(int(self.max_depth * self.DEPTH_SHARE[priority]), 1):
+            self.rejected += 1
+            self.rejected_by_class[priority] += 1
+            raise asyncio.QueueFull
+        entry = (PRIORITY_CLASSES.index(priority), next(self._sequence),
+                 priority, time.monotonic(), func, kwargs)
+        self._queue.put_nowait(entry)
+        self.queued[priority] += 1
+
+    async def _worker(self) -> None:
+        while True:
+            level, sequence, priority, queued_at, func, kwargs = await self._queue.get()
+            self.queued[priority] -= 1
+            self.wait_time[priority].add(time.monotonic() - queued_at)
+            self.busy += 1
+            try:
+                await func(**kwargs)
+            except Exception as e:
+                msg = f'Delivery of queued push failed: {e.__class__.__name__} {e}'
+                log_event(loggers=settings.params.loggers, msg=msg, level='error')
+            finally:
+                self.busy -= 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {'depth': self.depth,
+                'max_depth': self.max_depth,
+                'workers': self.workers,
+                'busy_workers': self.busy,
+                'rejected': self.rejected,
+                'classes': {name: {'depth': self.queued[name],
+                                   'max_depth': max(int(self.max_depth * self.DEPTH_SHARE[name]), 1),
+                                   'rejected': self.rejected_by_class[name],
+                                   'wait_time': self.wait_time[name].stats()}
+                            for name in PRIORITY_CLASSES}}
@@ -0,0 +1,119 @@
+import atexit
+import logging
+import queue
+
+from logging.handlers import QueueHandler, QueueListener
+
+from application.python.types import Singleton
+
+__all__ = ['LogQueue']
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue log records for the log thread, as they are.
+
+    When the queue is over its high water mark debug records are dropped,
+    and a warning with the number of dropped records is logged with the
+    next record that is queued.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.pending_dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # records stay in this process, the log thread formats them
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        log_queue = self.log_queue
+        if record.levelno <= logging.DEBUG and self.queue.qsize() >= log_queue.high_water:
+            log_queue.dropped += 1
+            self.pending_dropped += 1
+            return
+
+        if self.pending_dropped:
+            dropped, self.pending_dropped = self.pending_dropped, 0
+            msg = f'log queue is full, {dropped} debug messages dropped'
+            summary = logging.LogRecord(record.name, logging.WARNING, __file__, 0, msg, None, None)
+            self.queue.put(summary)
+        self.queue.put(record)
+
+
+class LogListener(QueueListener):
+    """
+    Queue listener waiting for room in a full queue when it is stopped
+    """
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+class LogQueue(object, metaclass=Singleton):
+    """
+    Write log records from a thread.
+
+    The handlers of the logger are moved behind a queue, logging only
+    queues the record and the log thread formats and writes it.
+    """
+
+    DEFAULT_SIZE = 10000
+    HIGH_WATER = 0.8
+
+    def __init__(self):
+        atexit.register(self.stop)
+        self.queue = queue.Queue(self.DEFAULT_SIZE)
+        self.handler = DroppingQueueHandler(self)
+        self.handlers = []
+        self.logger = None
+        self.listener = None
+        self.dropped = 0
+
+    @property
+    def high_water(self) -> int:
+        return int(self.queue.maxsize * self.HIGH_WATER)
+
+    def attach(self, logger: logging.Logger, size: int = DEFAULT_SIZE) -> None:
+        """
+        Move the handlers of logger to the log thread, starting it if needed.
+        Can be called again when handlers are added to the logger.
+
+        :param logger: `logging.Logger` logger to write from the log thread
+        :param size: `int` maximum number of queued records
+        """
+        self.queue.maxsize = max(size, 1)
+        self.logger = logger
+
+        for handler in list(logger.handlers):
+            if handler is not self.handler:
+                logger.removeHandler(handler)
+                self.handlers.append(handler)
+        if self.handler not in logger.handlers:
+            logger.addHandler(self.handler)
+
+        if self.listener is None:
+            self.listener = LogListener(self.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+        else:
+            self.listener.handlers = tuple(self.handlers)
+
+    def stop(self) -> None:
+        """
+        Write the queued records, stop the log thread and give the
+        handlers back to the logger
+        """
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+
+        self.logger.removeHandler(self.handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.handlers = []
+
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(),
+                'dropped': self.dropped}
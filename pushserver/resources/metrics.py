@@ -0,0 +1,47 @@
+from collections import defaultdict
+
+from application.python.types import Singleton
+
+__all__ = ['LatencyStats', 'PushMetrics']
+
+
+class LatencyStats(object):
+    """
+    Running count, average and maximum of a duration
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        """
+        :param value: `float` duration in seconds
+        """
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def stats(self) -> dict:
+        return {'count': self.count,
+                'average': round(self.average, 6),
+                'max': round(self.max, 6)}
+
+
+class PushMetrics(object, metaclass=Singleton):
+    """
+    Metrics of the push notifications sent by the server
+    """
+
+    def __init__(self):
+        self.delivery_time = defaultdict(LatencyStats)
+
+    def stats(self) -> dict:
+        return {'delivery_time': {name: latency.stats()
+                                  for name, latency in self.delivery_time.items()}}
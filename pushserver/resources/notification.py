@@ -1,11 +1,20 @@
+import asyncio
 import importlib
-import json
+import time
+from collections import Counter
+
+from starlette.concurrency import run_in_threadpool
 
 from pushserver.models.requests import WakeUpRequest
-from pushserver.resources import settings
+from pushserver.resources import codec, settings
+from pushserver.resources.calls import CallRegistry
+from pushserver.resources.delivery import priority_class
+from pushserver.resources.metrics import PushMetrics
+from pushserver.resources.templates import TEMPLATE_FIELDS
 
 
-def handle_request(wp_request, request_id: str) -> dict:
+async def handle_request(wp_request, request_id: str, shared_payloads=None,
+                         account: str = None) -> dict:
     """
     Create a PushNotification object,
     and call methods to send the notification.
@@ -13,24 +22,134 @@ def handle_request(wp_request, request_id: str) -> dict:
     :param wp_request: `WakeUpRequest', received from /push route.
     :param loggers: `dict` global logging instances to write messages (params.loggers)
     :param request_id: `str`, request ID generated on request event.
+    :param shared_payloads: `SharedPayloads` (optional) payloads of the fan-out the request belongs to
+    :param account: `str` (optional) account woken up, the called SIP URI if not set
     :return: a `dict` with push notification results
     """
-    push_notification = PushNotification(wp_request=wp_request, request_id=request_id)
-    results = push_notification.send_notification()
+    calls = CallRegistry()
+    call_key = calls.key(account or wp_request.sip_to, wp_request.call_id)
+    wake_up = calls.is_wake_up(wp_request.event)
+    if wake_up and calls.is_cancelled(call_key):
+        calls.drop(call_key, request_id)
+        return {'code': 487, 'body': {}, 'reason': 'call cancelled',
+                'platform': wp_request.platform, 'call_id': wp_request.call_id,
+                'token': wp_request.token}
+
+    started_at = time.monotonic()
+    push_notification = PushNotification(wp_request=wp_request, request_id=request_id,
+                                         shared_payloads=shared_payloads, call_key=call_key)
+    if wake_up:
+        calls.start(call_key)
+    try:
+        results = await push_notification.send_notification()
+    finally:
+        if wake_up:
+            calls.finish(call_key)
+
+    delivery_class = priority_class(wp_request.event, wp_request.media_type)
+    PushMetrics().delivery_time[delivery_class].add(time.monotonic() - started_at)
     return results
 
 
+class SharedPayloads(object):
+    """
+    Payloads serialized once for all the devices of a fan-out.
+
+    Devices whose wake up requests only differ by token share a payload.
+    It is serialized with two placeholder tokens: if the results only
+    differ where the token is, the payload is kept as bytes split around
+    the token and each device gets the parts joined with its own token
+    (nothing to join for APNs, where the token is not in the body).
+    Otherwise each device payload is serialized on its own, as are the
+    payloads no other device of the fan-out shares.
+    """
+
+    TOKENS = ('\x00shared-payload-token-a\x00', '\x00shared-payload-token-b\x00')
+
+    def __init__(self, wp_requests=()):
+        """
+        :param wp_requests: iterable of the `WakeUpRequest` of the fan-out
+        """
+        self._payloads = {}
+        self._devices = Counter()
+        for wp_request in wp_requests:
+            try:
+                self._devices[self.key(wp_request)] += 1
+            except TypeError:
+                pass
+
+    @staticmethod
+    def key(wp_request: WakeUpRequest) -> tuple:
+        """
+        :return: a `tuple` with the payload arguments of a wake up request, except the token
+        """
+        return (wp_request.platform, wp_request.app_id, wp_request.event,
+                wp_request.call_id, wp_request.sip_from, wp_request.from_display_name,
+                wp_request.sip_to, wp_request.media_type, wp_request.silent,
+                wp_request.reason, wp_request.badge, wp_request.filename,
+                wp_request.filetype, wp_request.account, wp_request.content,
+                wp_request.content_type)
+
+    @staticmethod
+    def encode_token(token: str) -> bytes:
+        return codec.dumpb(token)[1:-1]
+
+    def get(self, key: tuple, token: str, serialize):
+        """
+        :param key: `tuple` from SharedPayloads.key
+        :param token: `str` token of the device
+        :param serialize: function returning the payload for a token
+        :return: the payload of the device
+        """
+        try:
+            if self._devices[key] < 2:
+                return serialize(token)
+            parts = self._payloads.get(key)
+        except TypeError:
+            return serialize(token)
+
+        if parts is None:
+            parts = self._payloads[key] = self._split(serialize)
+
+        if not parts:
+            return serialize(token)
+        if len(parts) == 1:
+            return parts[0]
+        return self.encode_token(token).join(parts)
+
+    def _split(self, serialize) -> list:
+        payloads = []
+        for token in self.TOKENS:
+            payload = serialize(token)
+            if isinstance(payload, str):
+                payload = payload.encode()
+            if not isinstance(payload, bytes):
+                return []
+            payloads.append(payload)
+
+        first, second = payloads
+        token_a, token_b = (self.encode_token(token) for token in self.TOKENS)
+        if first.replace(token_a, token_b) != second:
+            return []
+        return first.split(token_a)
+
+
 class PushNotification(object):
     """
     Push Notification actions from wake up request
     """
 
-    def __init__(self, wp_request: WakeUpRequest, request_id: str):
+    def __init__(self, wp_request: WakeUpRequest, request_id: str, shared_payloads: SharedPayloads = None,
+                 call_key: tuple = None):
         """
         :param wp_request: `WakeUpRequest`, from http request
         :param request_id: `str`, request ID generated on request event.
+        :param shared_payloads: `SharedPayloads` (optional) payloads of the fan-out
+        :param call_key: `tuple` (optional) key of the call in the CallRegistry
         """
         self.wp_request = wp_request
+        self.shared_payloads = shared_payloads
+        self.call_key = call_key
         self.app_id = self.wp_request.app_id
         self.platform = self.wp_request.platform
         self.pns_register = settings.params.pns_register
@@ -56,45 +175,141 @@ class PushNotification(object):
         custom_apps = set(app for app in apps if app not in ('sylk', 'linphone'))
         return custom_apps
 
-    def send_notification(self) -> dict:
+    def cached_headers(self, register: dict, headers_class) -> dict:
+        """
+        Headers built once per app and event, with the current authorization.
+        The cache belongs to the register and is dropped when the config is reloaded.
+
+        :param register: `dict` register entries of the app
+        :param headers_class: headers class of the app, with cache_headers set
+        :return: a `dict` with the push notification headers
+        """
+        headers_cache = register['headers_cache']
+        event = self.wp_request.event
+        try:
+            static_headers = headers_cache[event]
+        except KeyError:
+            static_headers = headers_cache[event] = headers_class(*self.args).static_headers
+
+        headers = dict(static_headers)
+        headers.update(headers_class.auth_headers(self.app_id))
+        return headers
+
+    def serialize_payload(self, token: str):
+        """
+        Serialize the payload of the push notification for a token
+
+        :param token: `str` device token
+        :return: the payload as `str` or `bytes`, None if it can not be serialized
+        """
+        args = list(self.args)
+        args[2] = token
+        register = self.pns_register[(self.app_id, self.platform)]
+        payload_templates = register['payload_templates']
+        payload_template = payload_templates.get(self.wp_request.event, payload_templates.get(None))
+        if payload_template:
+            return payload_template.render(dict(zip(TEMPLATE_FIELDS, args)))
+
+        payload_dict = register['payload_class'](*args).payload
+        try:
+            return codec.dumpb(payload_dict)
+        except Exception:
+            return None
+
+    async def send_notification(self) -> dict:
         """
         Send a push notification according to wakeup request params.
+
+        Push requests with a coroutine `send_notification` are awaited on the
+        event loop, others still send from their constructor and are run
+        in the threadpool so they can not block it.
         """
+        register = self.pns_register[(self.app_id, self.platform)]
+        # the connections of a register replaced by a reload are closed
+        # once its pushes are done
+        register['pushes'] += 1
+        try:
+            return await self._send_notification(register)
+        finally:
+            register['pushes'] -= 1
+
+    async def _send_notification(self, register: dict) -> dict:
         error = ''
+        credentials = register.get('credentials')
+        if credentials is not None:
+            await credentials.get_token()
+
         headers_class = self.pns_register[(self.app_id, self.platform)]['headers_class']
-        headers = headers_class(*self.args).headers
+        if getattr(headers_class, 'cache_headers', False):
+            headers = self.cached_headers(register, headers_class)
+        else:
+            headers = headers_class(*self.args).headers
 
         payload_class = self.pns_register[(self.app_id, self.platform)]['payload_class']
-        payload_dict = payload_class(*self.args).payload
-        try:
-            payload = json.dumps(payload_dict)
-        except Exception:
-            payload = None
+        if self.shared_payloads is not None:
+            key = self.shared_payloads.key(self.wp_request)
+            payload = self.shared_payloads.get(key, self.wp_request.token, self.serialize_payload)
+        else:
+            payload = self.serialize_payload(self.wp_request.token)
 
         if not (headers and payload):
             error = f'{headers_class.__name__} and {payload_class.__name__} ' \
                     f'returned bad objects:' \
                     f'{headers}, {payload}'
 
-        if not isinstance(headers, dict) or not isinstance(payload, str):
+        if not isinstance(headers, dict) or not isinstance(payload, (str, bytes)):
             error = f'{headers_class.__name__} and {payload_class.__name__} ' \
                     f'returned bad objects:' \
                     f'{headers}, {payload}'
 
-        register = self.pns_register[(self.app_id, self.platform)]
-        platform_module = importlib.import_module(f'pushserver.pns.{self.platform}')
-
-        push_request_class = getattr(platform_module,
-                                     f'{self.platform.capitalize()}PushRequest')
-
-        push_request = push_request_class(error=error,
-                                          app_name=self.app_name,
-                                          app_id=self.app_id,
-                                          request_id=self.request_id,
-                                          headers=headers,
-                                          payload=payload,
-                                          loggers=self.loggers,
-                                          log_remote=self.log_remote,
-                                          wp_request=self.wp_request,
-                                          register=register)
-        return push_request.results
+        breaker = None if error else register.get('breaker')
+        if breaker is not None and not breaker.allow():
+            return {'code': 503, 'body': {},
+                    'reason': 'upstream unavailable, circuit breaker is open',
+                    'platform': self.platform, 'call_id': self.wp_request.call_id,
+                    'token': self.wp_request.token}
+
+        # a push let through by the breaker is recorded or released on every exit
+        outcome = None
+        try:
+            rate_limiter = register.get('rate_limiter')
+            if rate_limiter is not None:
+                await rate_limiter.acquire(priority_class(self.wp_request.event,
+                                                          self.wp_request.media_type))
+
+            platform_module = importlib.import_module(f'pushserver.pns.{self.platform}')
+
+            push_request_class = getattr(platform_module,
+                                         f'{self.platform.capitalize()}PushRequest')
+
+            push_request_args = {'error': error,
+                                 'app_name': self.app_name,
+                                 'app_id': self.app_id,
+                                 'request_id': self.request_id,
+                                 'headers': headers,
+                                 'payload': payload,
+                                 'loggers': self.loggers,
+                                 'log_remote': self.log_remote,
+                                 'wp_request': self.wp_request,
+                                 'register': register}
+
+            send = getattr(push_request_class, 'send_notification', None)
+            if not asyncio.iscoroutinefunction(send):
+                push_request = await run_in_threadpool(push_request_class, **push_request_args)
+                results = push_request.results
+            else:
+                push_request = push_request_class(**push_request_args)
+                push_request.call_key = self.call_key
+                results = await push_request.send_notification()
+
+            code = results.get('code')
+            if code != 487:
+                failed = isinstance(code, int) and code >= 500 and not push_request.device_error
+                outcome = (not failed, push_request.latency)
+        finally:
+            if breaker is not None:
+                if outcome is None:
+                    breaker.release()
+                else:
+                    breaker.record(success=outcome[0], latency=outcome[1])
+        return results
@@ -0,0 +1,243 @@
+import asyncio
+import socket
+import time
+from collections import deque
+
+from application.python.types import Singleton
+from httpx import AsyncClient, HTTPError, Limits
+
+from pushserver.resources import codec, settings
+from pushserver.resources.utils import log_enabled, log_event
+
+__all__ = ['RemoteLogShipper']
+
+
+class RemoteLogTarget(object):
+    """
+    Remote log records waiting to be sent to a log_remote_urls entry
+    """
+
+    def __init__(self, url: str, log_key: str = None, timeout: float = None, batch_size: int = 1):
+        """
+        :param url: `str` remote log url
+        :param log_key: `str` (optional) key of the response logged
+        :param timeout: `float` (optional) seconds to wait for the remote server
+        :param batch_size: `int` records sent in a single request, as a list if more than 1
+        """
+        self.url = url
+        self.log_key = log_key
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.records = deque()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def stats(self) -> dict:
+        return {'queued': len(self.records),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'backoff': round(max(self.retry_at - time.monotonic(), 0), 3)}
+
+
+class RemoteLogShipper(object, metaclass=Singleton):
+    """
+    Send the remote log records of the pushes in the background.
+
+    Records wait in a queue per remote log url, shared by all apps, at most
+    log_remote_queue_size records in total, new records are dropped when
+    it is full. Each url is served by CONCURRENCY tasks, each sending
+    batch_size records per request over a shared connection pool. After a
+    failure the url is not tried for BACKOFF_MIN seconds, doubled on each
+    new failure up to BACKOFF_MAX, and the records of the failed request are
+    dropped.
+    """
+
+    BACKOFF_MIN = 1
+    BACKOFF_MAX = 60
+    DEFAULT_TIMEOUT = 2
+    CONCURRENCY = 10
+    MAX_CONNECTIONS = 100
+
+    def __init__(self):
+        self.size = settings.params.log_remote_queue_size
+        self.targets = {}
+        self.queued = 0
+        self.dropped = 0
+        self.client = None
+        self.loop = None
+        self._server_ip = None
+        self._stopping = False
+
+    @property
+    def server_ip(self) -> str:
+        """
+        Local address used to reach the internet, found once
+        """
+        if self._server_ip is None:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.connect(('1.2.3.4', 1))
+                    self._server_ip = s.getsockname()[0]
+            except socket.error:
+                return None
+        return self._server_ip
+
+    def submit(self, url: str, record: dict, request_id: str, log_key: str = None,
+               timeout: float = None, batch_size: int = 1) -> None:
+        """
+        Queue a record to be sent to a remote log url, from any thread
+
+        :param url: `str` remote log url
+        :param record: `dict` remote log record
+        :param request_id: `str` request ID of the push, used in logs
+        :param log_key: `str` (optional) key of the response logged
+        :param timeout: `float` (optional) seconds to wait for the remote server
+        :param batch_size: `int` records sent in a single request
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self.loop is None or self.loop.is_closed():
+                self.dropped += 1
+                return
+            self.loop.call_soon_threadsafe(self._put, url, record, request_id,
+                                           log_key, timeout, batch_size)
+            return
+
+        self.loop = loop
+        self._put(url, record, request_id, log_key, timeout, batch_size)
+
+    def _put(self, url: str, record: dict, request_id: str, log_key: str,
+             timeout: float, batch_size: int) -> None:
+        key = (url, log_key, timeout, batch_size)
+        try:
+            target = self.targets[key]
+        except KeyError:
+            target = self.targets[key] = RemoteLogTarget(url, log_key, timeout, batch_size)
+
+        if self.queued >= self.size:
+            self.dropped += 1
+            target.dropped += 1
+            return
+
+        target.records.append((request_id, record))
+        self.queued += 1
+        target.wakeup.set()
+        target.tasks = [task for task in target.tasks if not task.done()]
+        batches = -(-len(target.records) // target.batch_size)
+        if len(target.tasks) < min(self.CONCURRENCY, batches):
+            target.tasks.append(asyncio.create_task(self._ship(target)))
+
+    async def _ship(self, target: RemoteLogTarget) -> None:
+        if self.client is None:
+            self.client = AsyncClient(limits=Limits(max_connections=self.MAX_CONNECTIONS))
+
+        while not self._stopping:
+            if not target.records:
+                target.wakeup.clear()
+                await target.wakeup.wait()
+                continue
+
+            delay = target.retry_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            batch = [target.records.popleft()
+                     for _ in range(min(target.batch_size, len(target.records)))]
+            self.queued -= len(batch)
+            await self._send(target, batch)
+
+    async def _send(self, target: RemoteLogTarget, batch: list) -> None:
+        request_ids = ', '.join(request_id for request_id, record in batch)
+        records = [record for request_id, record in batch]
+        content = codec.dumpb(records if target.batch_size > 1 else records[0])
+        task = 'log remote'
+
+        if log_enabled(settings.params.loggers, 'deb'):
+            msg = f'{task} request {request_ids} to {target.url} body: {content.decode()}'
+            log_event(loggers=settings.params.loggers, msg=msg, level='deb')
+
+        try:
+            response = await self.client.post(target.url, content=content,
+                                              headers={'Content-Type': 'application/json'},
+                                              timeout=target.timeout or self.DEFAULT_TIMEOUT)
+        except HTTPError as e:
+            self._failed(target, len(batch), f'connection error {e}')
+            return
+
+        if response.status_code >= 500:
+            self._failed(target, len(batch), f'code {response.status_code}')
+            return
+
+        target.sent += len(batch)
+        target.failures = 0
+        target.retry_at = 0
+        self._log_response(target, request_ids, response)
+
+    def _failed(self, target: RemoteLogTarget, records: int, reason: str) -> None:
+        target.failed += records
+        if target.retry_at > time.monotonic():
+            # a concurrent request already failed, the url is backing off
+            return
+        target.failures += 1
+        backoff = min(self.BACKOFF_MIN * 2 ** (target.failures - 1), self.BACKOFF_MAX)
+        target.retry_at = time.monotonic() + backoff
+        msg = f'log remote to {target.url} failed: {reason}, ' \
+              f'{records} records dropped, next try in {backoff} seconds'
+        log_event(loggers=settings.params.loggers, msg=msg, level='error')
+
+    def _log_response(self, target: RemoteLogTarget, request_ids: str, response) -> None:
+        task = 'log remote'
+        code = response.status_code
+        if not target.log_key:
+            if log_enabled(settings.params.loggers, 'deb'):
+                msg = f'{task} response for request {request_ids} ' \
+                      f'from {target.url}: {code} {response.text[:500]}'
+                log_event(loggers=settings.params.loggers, msg=msg, level='deb')
+            return
+
+        try:
+            value = codec.loads(response.content).get(target.log_key)
+        except (codec.DecodeError, AttributeError):
+            value = None
+
+        if value:
+            msg = f'{task} response for request {request_ids} from {target.url} - ' \
+                  f'{code} {target.log_key}: {value}'
+            log_event(loggers=settings.params.loggers, msg=msg, level='deb')
+        else:
+            msg = f'{task} response for request {request_ids} - ' \
+                  f'code: {code}, key not found'
+            log_event(loggers=settings.params.loggers, msg=msg, level='error')
+
+    async def stop(self) -> None:
+        """
+        Stop sending, records still queued are dropped
+        """
+        # a task cancelled inside the client may go on, it also stops
+        # when woken up
+        self._stopping = True
+        tasks = []
+        for target in self.targets.values():
+            tasks.extend(target.tasks)
+            target.tasks = []
+            target.wakeup.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._stopping = False
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def stats(self) -> dict:
+        return {'queued': self.queued,
+                'dropped': self.dropped,
+                'urls': {target.url: target.stats() for target in self.targets.values()}}
@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+from collections import defaultdict
+
+from application.python.types import Singleton
+
+__all__ = ['RetryCancelled', 'RetryScheduler']
+
+
+class RetryCancelled(Exception):
+    pass
+
+
+class RetryScheduler(object, metaclass=Singleton):
+    """
+    Park push notifications waiting for a retry and wake them up
+    on the event loop when they are due.
+
+    Parked retries are kept in a heap ordered by due time and a single
+    loop timer is armed for the earliest one, so waiting retries do
+    not hold a thread or a timer each. Retries parked with a key can be
+    cancelled together.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self._timer_due = None
+        self._keys = defaultdict(set)
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of retries waiting to be fired
+        """
+        return sum(1 for entry in self._heap if not entry[2].done())
+
+    @staticmethod
+    def backoff(counter: int, backoff_factor: float) -> float:
+        """
+        Delay before a retry, following rfc3261 exponential backoff:
+        T1 = backoff_factor, doubled for each retry.
+
+        :param counter: `int` number of the retry, starting at 1
+        :param backoff_factor: `float` delay before the first retry
+        :return: a `float` with the delay in seconds
+        """
+        return backoff_factor * (2 ** (counter - 1))
+
+    async def wait(self, delay: float, key=None) -> None:
+        """
+        Park the caller until the retry is due.
+        :param delay: `float` seconds to wait
+        :param key: (optional) hashable key to cancel the retry with cancel(key)
+        :raise RetryCancelled: if the retry was cancelled while parked
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._heap, (loop.time() + delay, next(self._sequence), future))
+        self.scheduled += 1
+        if key is not None:
+            self._keys[key].add(future)
+        self._arm_timer(loop)
+        try:
+            await future
+        finally:
+            if not future.done():
+                future.cancel()
+            if key is not None:
+                self._keys[key].discard(future)
+                if not self._keys[key]:
+                    del self._keys[key]
+
+    def cancel(self, key) -> int:
+        """
+        Cancel the parked retries with this key
+        :param key: key given to wait
+        :return: `int` number of cancelled retries
+        """
+        cancelled = 0
+        for future in self._keys.pop(key, ()):
+            if not future.done():
+                future.set_exception(RetryCancelled())
+                cancelled += 1
+        self.cancelled += cancelled
+        return cancelled
+
+    def _arm_timer(self, loop) -> None:
+        if not self._heap:
+            return
+
+        due = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_due <= due:
+                return
+            self._timer.cancel()
+
+        self._timer_due = due
+        self._timer = loop.call_at(due, self._fire_due, loop, due)
+
+    def _fire_due(self, loop, timer_due: float) -> None:
+        self._timer = None
+        now = max(loop.time(), timer_due)
+        while self._heap and self._heap[0][0] <= now:
+            due, sequence, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+                self.fired += 1
+        self._arm_timer(loop)
+
+    def stats(self) -> dict:
+        return {'pending': self.pending,
+                'scheduled': self.scheduled,
+                'fired': self.fired,
+                'cancelled': self.cancelled}
@@ -8,13 +8,19 @@ from fastapi.exceptions import RequestValidationError
 from pushserver import __info__ as package_info
 from pushserver.api.errors.validation_error import validation_exception_handler
 from pushserver.api.routes.api import router
+from pushserver.pns.apple import AppleTokenManager
+from pushserver.pns.register import close_pns_connections, close_replaced_pns_connections
 from pushserver.resources import settings
+from pushserver.resources.delivery import DeliveryQueue
+from pushserver.resources.logs import LogQueue
+from pushserver.resources.remotelog import RemoteLogShipper
 from pushserver.resources.utils import log_event
 
 
 def get_server() -> FastAPI:
     server = FastAPI(title='sylk-pushserver', version=package_info.__version__, debug=True)
     server.add_event_handler("startup", create_start_server_handler())
+    server.add_event_handler("shutdown", create_stop_server_handler())
     server.add_exception_handler(RequestValidationError, validation_exception_handler)
     server.include_router(router)
     return server
@@ -43,10 +49,13 @@ async def autoreload_read_config(wait_for: float = 0.1) -> None:
             path_modified = last_st_mtime != os.stat(path).st_mtime
             if path_modified:
                 to_watch[path] = os.stat(path).st_mtime
+                pns_register = settings.params.pns_register
                 settings.params = settings.update_params(settings.params.config_dir,
                                                          settings.params.debug,
                                                          settings.params.ip,
                                                          settings.params.port)
+                if settings.params.pns_register is not pns_register:
+                    asyncio.create_task(close_replaced_pns_connections(pns_register))
                 await asyncio.sleep(wait_for)
                 break
             await asyncio.sleep(wait_for)
@@ -59,6 +68,10 @@ def create_start_server_handler() -> Callable:  # type: ignore
 
         asyncio.create_task(autoreload_read_config(wait_for=wait_for))
 
+        if not settings.params.return_async:
+            DeliveryQueue().start()
+        AppleTokenManager().start()
+
         level = 'info'
         loggers = settings.params.loggers
         register = settings.params.register
@@ -106,6 +119,20 @@ def create_start_server_handler() -> Callable:  # type: ignore
                 msg = f'{name.capitalize()} log remote settings: {log_settings}'
                 log_event(loggers=loggers, msg=msg, level='deb')
 
+            rate_limiter = pns_register[app].get('rate_limiter')
+            if rate_limiter is not None:
+                msg = f"{name.capitalize()} app {app_id} rate limit: " \
+                      f"{rate_limiter.rate} pushes per second, burst of {rate_limiter.burst}"
+                log_event(loggers=loggers, msg=msg, level='deb')
+
+            breaker = pns_register[app].get('breaker')
+            if breaker is not None:
+                msg = f"{name.capitalize()} app {app_id} circuit breaker is {breaker.state}, " \
+                      f"opens at {breaker.error_rate:.0%} failures of the last {breaker.window} pushes" \
+                      f"{f' or slower than {breaker.latency}s' if breaker.latency else ''}, " \
+                      f"for {breaker.open_time} seconds"
+                log_event(loggers=loggers, msg=msg, level='info')
+
         invalid_apps = register['invalid_apps']
         for app in invalid_apps.keys():
             app_id, platform = app[0], app[1]
@@ -147,4 +174,20 @@ def create_start_server_handler() -> Callable:  # type: ignore
     return start_server
 
 
+def create_stop_server_handler() -> Callable:  # type: ignore
+
+    async def stop_server() -> None:
+        # storage configuration is read once config_dir is known
+        from pushserver.resources.storage import TokenStorage
+
+        await DeliveryQueue().stop()
+        await AppleTokenManager().stop()
+        await close_pns_connections(settings.params.pns_register)
+        await RemoteLogShipper().stop()
+        TokenStorage().close()
+        LogQueue().stop()
+
+    return stop_server
+
+
 server = get_server()
@@ -3,6 +3,7 @@ import logging
 import os
 from ipaddress import ip_network
 from pushserver.pns.register import get_pns_from_config
+from pushserver.resources.logs import LogQueue
 from application import log
 
 
@@ -37,6 +38,12 @@ class ConfigParams(object):
         self.register = self.set_register()
         self.allowed_pool = self.set_allowed_pool()
         self.return_async = self.set_return_async()
+        self.fanout_concurrency = self.read_setting('server', 'fanout_concurrency', 8, int)
+        self.delivery_workers = self.read_setting('server', 'delivery_workers', 20, int)
+        self.delivery_queue_size = self.read_setting('server', 'delivery_queue_size', 1000, int)
+        self.dedup_window = self.read_setting('server', 'dedup_window', 3.0, float)
+        self.dedup_size = self.read_setting('server', 'dedup_size', 10000, int)
+        self.log_remote_queue_size = self.read_setting('server', 'log_remote_queue_size', 10000, int)
 
     def set_dir(self):
         """
@@ -211,8 +218,10 @@ class ConfigParams(object):
 
         debug = debug or self.debug
         loggers['debug'] = debug
-        if debug:
-            logger_journal.setLevel(logging.DEBUG)
+        logger_journal.setLevel(logging.DEBUG if debug else logging.INFO)
+
+        log_queue_size = self.read_setting('server', 'log_queue_size', LogQueue.DEFAULT_SIZE, int)
+        LogQueue().attach(logger_journal, size=log_queue_size)
 
         debug_hpack = False
         try:
@@ -223,6 +232,9 @@ class ConfigParams(object):
         if not debug_hpack:
             logging.getLogger("hpack").setLevel(logging.INFO)
 
+        # httpx logs every request at info level, pushes are logged already
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
         return loggers
 
     def set_register(self):
@@ -301,6 +313,32 @@ class ConfigParams(object):
 
         return return_async
 
+    def read_setting(self, section: str, option: str, default, value_type=str):
+        """
+        Read an optional setting from general.ini
+        :param section: `str` section of general.ini
+        :param option: `str` name of the setting
+        :param default: value used if the setting is missing or not valid
+        :param value_type: `type` to convert the setting to
+        """
+        if self.file['error']:
+            return default
+
+        config = configparser.ConfigParser()
+        config.read(self.file['path'])
+        try:
+            value = config[section][option]
+        except KeyError:
+            return default
+
+        try:
+            if value_type is bool:
+                return value.lower() == 'true'
+            return value_type(value)
+        except ValueError:
+            log.warning(f'{section} {option} = {value} - bad value, using {default}')
+            return default
+
 
 def init(config_dir, debug, ip, port):
     global params
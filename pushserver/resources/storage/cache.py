@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+__all__ = 'TokenCache',
+
+
+class TokenCache(object):
+    """
+    Tokens of the most recently used accounts, kept for ttl seconds.
+
+    Accounts found without tokens and forgotten are kept as such for
+    negative_ttl seconds. At most size accounts are kept, the least recently used are evicted
+    first. Cached tokens are copied in and out, so callers can change them.
+    Storage methods also run in the threadpool, the entries are locked, and
+    tokens read before an invalidation are not cached.
+    """
+
+    def __init__(self, size: int, ttl: float, negative_ttl: float = 0):
+        """
+        :param size: `int` maximum number of accounts, 0 disables the cache
+        :param ttl: `float` seconds the tokens of an account are kept
+        :param negative_ttl: `float` seconds an account without tokens is kept
+        """
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def copy(tokens: dict) -> dict:
+        return {key: dict(device) for key, device in tokens.items()}
+
+    def get(self, account: str):
+        """
+        :param account: `str` account
+        :return: a copy of the cached tokens, None if not cached
+        """
+        with self._lock:
+            try:
+                expires_at, tokens = self._entries[account]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires_at <= time.monotonic():
+                del self._entries[account]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(account)
+            self.hits += 1
+        return self.copy(tokens)
+
+    def set(self, account: str, tokens: dict, generation: int = None) -> None:
+        """
+        :param account: `str` account
+        :param tokens: `dict` tokens of the account, accounts without tokens are not cached
+        :param generation: `int` (optional) generation read before the tokens
+        """
+        if tokens:
+            self._set(account, tokens, self.ttl, generation)
+
+    def forget(self, account: str, generation: int = None) -> None:
+        """
+        Keep an account without tokens for negative_ttl seconds
+        :param account: `str` account
+        :param generation: `int` (optional) generation read before the account was found empty
+        """
+        self._set(account, {}, self.negative_ttl, generation)
+
+    def forgotten(self, account: str) -> bool:
+        """
+        Check if an account was forgotten less than negative_ttl seconds ago
+        """
+        entry = self._entries.get(account)
+        return entry is not None and not entry[1] and entry[0] > time.monotonic()
+
+    def _set(self, account: str, tokens: dict, ttl: float, generation: int = None) -> None:
+        if self.size <= 0 or ttl <= 0:
+            return
+        entry = (time.monotonic() + ttl, self.copy(tokens))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[account] = entry
+            self._entries.move_to_end(account)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, account: str) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(account, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries),
+                'negative': sum(1 for expires_at, tokens in list(self._entries.values()) if not tokens),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0}
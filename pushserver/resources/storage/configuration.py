@@ -48,6 +48,9 @@ class CassandraConfig(ConfigSection):
     cluster_contact_points = ConfigSetting(type=HostnameList, value=None)
     keyspace = ConfigSetting(type=str, value='')
     table = ConfigSetting(type=str, value='')
+    cache_size = ConfigSetting(type=int, value=10000)
+    cache_ttl = ConfigSetting(type=float, value=30)
+    negative_cache_ttl = ConfigSetting(type=float, value=10)
     debug = False
 
 class ServerConfig(ConfigSection):
@@ -1,14 +1,19 @@
+import asyncio
 import logging
 import os
+import threading
+from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 
 import _pickle as pickle
 from application.python.types import Singleton
 from application.system import makedirs
+from starlette.concurrency import run_in_threadpool
 
 from pushserver.resources import settings
 from pushserver.resources.utils import log_event
 
+from .cache import TokenCache
 from .configuration import CassandraConfig, ServerConfig
 from .errors import StorageError
 
@@ -42,22 +47,211 @@ else:
             PushTokens.__table_name__ = CassandraConfig.table
 
 
-class FileStorage(object):
+class StorageLookup(object, metaclass=ABCMeta):
+    """
+    Asynchronous reads of the tokens of an account.
+
+    Lookups of the same account made while a read of the storage is in
+    progress share that read, each caller gets its own copy of the tokens.
+    Only reads that wait, like the Cassandra queries run in the threadpool,
+    can be shared.
+    """
+
     def __init__(self):
+        self._lookups = {}
+        self.coalesced = 0
+
+    @abstractmethod
+    async def _read(self, account):
+        """
+        Read the tokens of an account from the storage
+        """
+
+    async def lookup(self, account):
+        future = self._lookups.get(account)
+        if future is not None:
+            self.coalesced += 1
+            return TokenCache.copy(await asyncio.shield(future))
+
+        future = self._lookups[account] = asyncio.get_running_loop().create_future()
+        try:
+            tokens = await self._read(account)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        else:
+            future.set_result(tokens)
+        finally:
+            del self._lookups[account]
+        return TokenCache.copy(tokens)
+
+    def close(self):
+        pass
+
+
+class FileStorage(StorageLookup):
+    """
+    Tokens kept in memory, saved in a pickle snapshot and a journal of the
+    changes made since.
+
+    Each add or remove appends a record to the journal, a writer thread
+    syncs the journal to disk every SYNC_INTERVAL seconds and, once it has
+    COMPACT_RECORDS records, writes a new snapshot and starts a new journal.
+    At load the journal is replayed over the snapshot.
+
+    Tokens are read from memory without waiting, so lookups are never
+    shared.
+    """
+
+    SNAPSHOT = 'webrtc_device_tokens'
+    SYNC_INTERVAL = 1
+    COMPACT_RECORDS = 10000
+
+    def __init__(self):
+        super().__init__()
         self._tokens = defaultdict()
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_records = 0
+        self._dirty = False
+        self._writer = None
+        self._stopped = threading.Event()
 
-    def _save(self):
-        with open(os.path.join(ServerConfig.spool_dir.normalized, 'webrtc_device_tokens'), 'wb+') as f:
-            pickle.dump(self._tokens, f)
+    async def _read(self, account):
+        return self[account]
+
+    def _path(self, suffix=''):
+        return os.path.join(ServerConfig.spool_dir.normalized, f'{self.SNAPSHOT}{suffix}')
 
     def load(self):
         try:
-            tokens = pickle.load(open(os.path.join(ServerConfig.spool_dir, 'webrtc_device_tokens'), 'rb'))
+            with open(self._path(), 'rb') as f:
+                tokens = pickle.load(f)
         except Exception:
             pass
         else:
             self._tokens.update(tokens)
 
+        # a journal.old is left if the server stopped while compacting, a
+        # journal is compacted even without records, so that new records
+        # are not appended after an incomplete one
+        replayed = [self._replay(self._path(suffix)) for suffix in ('.journal.old', '.journal')]
+        if any(replayed):
+            self._compact()
+
+    def _replay(self, path):
+        """
+        Apply the records of a journal
+        :param path: `str` path of the journal
+        :return: `bool` True if the journal has records or an incomplete record
+        """
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return False
+
+        records = 0
+        offset = 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            while offset < size:
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    break
+                self._apply(*record)
+                records += 1
+                offset = f.tell()
+
+        if offset < size:
+            msg = f'Token storage journal {path} ends with an incomplete record ' \
+                  f'at offset {offset}, ignoring it'
+            log_event(loggers=settings.params.loggers, msg=msg, level='warn')
+        return records > 0 or offset < size
+
+    def _apply(self, action, account, key, data=None):
+        if action == 'add':
+            self._tokens.setdefault(account, {})[key] = data
+            return
+
+        tokens = self._tokens.get(account)
+        if tokens is None:
+            return
+        if key is not None:
+            tokens.pop(key, None)
+        if not tokens:
+            del self._tokens[account]
+
+    def _append(self, record):
+        # called with the lock held
+        if self._journal is None:
+            self._journal = open(self._path('.journal'), 'ab')
+        pickle.dump(record, self._journal)
+        self._journal.flush()
+        self._journal_records += 1
+        self._dirty = True
+
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write, name='token-storage-writer', daemon=True)
+            self._writer.start()
+
+    def _write(self):
+        while not self._stopped.wait(self.SYNC_INTERVAL):
+            try:
+                self._sync()
+                if self._journal_records >= self.COMPACT_RECORDS:
+                    self._compact()
+            except OSError as e:
+                log_event(loggers=settings.params.loggers, msg=f'Saving token storage failed: {e}', level='error')
+
+    def _sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            journal = self._journal
+        os.fsync(journal.fileno())
+
+    def _compact(self):
+        with self._lock:
+            tokens = {account: dict(devices) for account, devices in self._tokens.items()}
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self._path('.journal')):
+                os.replace(self._path('.journal'), self._path('.journal.old'))
+            self._journal_records = 0
+            self._dirty = False
+
+        with open(self._path('.tmp'), 'wb') as f:
+            pickle.dump(tokens, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._path('.tmp'), self._path())
+        try:
+            os.remove(self._path('.journal.old'))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """
+        Stop the writer thread and sync the journal
+        """
+        self._stopped.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+                self._journal.close()
+                self._journal = None
+
     def __getitem__(self, key):
         try:
             return self._tokens[key]
@@ -80,22 +274,46 @@ class FileStorage(object):
         data['background_token'] = background_token
 
         key = f'{contact_params.app_id}-{contact_params.device_id}'
-        if account in self._tokens:
-            self._tokens[account][key] = data
-        else:
-            self._tokens[account] = {key: data}
-        self._save()
+        with self._lock:
+            self._apply('add', account, key, data)
+            self._append(('add', account, key, data))
 
-    def remove(self, account, app_id, device_id):
-        key = f'{app_id}-{device_id}'
-        try:
-            del self._tokens[account][key]
-        except KeyError:
-            pass
-        self._save()
+    def stats(self):
+        return {'accounts': len(self._tokens),
+                'journal': self._journal_records,
+                'coalesced': self.coalesced}
+
+    def remove(self, account, app_id=None, device_id=None):
+        with self._lock:
+            tokens = self._tokens.get(account)
+            if tokens is None:
+                return
+
+            if app_id or device_id:
+                key = f'{app_id}-{device_id}'
+                if key not in tokens:
+                    return
+            elif tokens:
+                return
+            else:
+                key = None
+
+            self._apply('remove', account, key)
+            self._append(('remove', account, key))
 
 
-class CassandraStorage(object):
+class CassandraStorage(StorageLookup):
+    def __init__(self):
+        super().__init__()
+        self._cache = TokenCache(CassandraConfig.cache_size, CassandraConfig.cache_ttl,
+                                 CassandraConfig.negative_cache_ttl)
+
+    async def _read(self, account):
+        tokens = self._cache.get(account)
+        if tokens is None:
+            tokens = await run_in_threadpool(self._query, account)
+        return tokens
+
     def load(self):
         connection_args = dict(
             load_balancing_policy=DCAwareRoundRobinPolicy(),
@@ -114,7 +332,7 @@ class CassandraStorage(object):
             msg='Not able to connect to any of the Cassandra contact points'
             log_event(loggers=settings.params.loggers, msg=msg, level='error')
 
-    def __getitem__(self, key):
+    def _query(self, key):
         def query_tokens(key):
             username, domain = key.split('@', 1)
             tokens = {}
@@ -127,7 +345,17 @@ class CassandraStorage(object):
                 log_event(loggers=settings.params.loggers, msg=f'Get token(s) failed: {e}', level='error')
                 raise StorageError
             return tokens
-        return query_tokens(key)
+
+        generation = self._cache.generation
+        tokens = query_tokens(key)
+        self._cache.set(key, tokens, generation)
+        return tokens
+
+    def __getitem__(self, key):
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = self._query(key)
+        return tokens
 
     def add(self, account, contact_params):
         username, domain = account.split('@', 1)
@@ -150,6 +378,8 @@ class CassandraStorage(object):
         except (CQLEngineException, InvalidRequest) as e:
             log_event(loggers=settings.params.loggers, msg=f'Storing token failed: {e}', level='error')
             raise StorageError
+        finally:
+            self._cache.invalidate(account)
         try:
             OpenSips.create(opensipskey=account, opensipsval='1')
         except (CQLEngineException, InvalidRequest) as e:
@@ -158,17 +388,30 @@ class CassandraStorage(object):
 
     def remove(self, account, app_id='', device_id=''):
         username, domain = account.split('@', 1)
-        try:
-            PushTokens.objects(PushTokens.username == username, PushTokens.domain == domain, PushTokens.device_id == device_id, PushTokens.app_id == app_id).if_exists().delete()
-        except LWTException:
-            pass
+        if app_id or device_id:
+            try:
+                PushTokens.objects(PushTokens.username == username, PushTokens.domain == domain, PushTokens.device_id == device_id, PushTokens.app_id == app_id).if_exists().delete()
+            except LWTException:
+                pass
+            finally:
+                self._cache.invalidate(account)
+        elif self._cache.forgotten(account):
+            # An account without tokens, already removed for OpenSIPS
+            return
 
         # We need to check for other device_ids/app_ids before we can remove the cache value for OpenSIPS
+        generation = self._cache.generation
         if not self[account]:
             try:
                 OpenSips.objects(OpenSips.opensipskey == account).if_exists().delete()
             except LWTException:
                 pass
+            self._cache.forget(account, generation)
+
+
+    def stats(self):
+        return {'cache': self._cache.stats(),
+                'coalesced': self.coalesced}
 
 
 class TokenStorage(object, metaclass=Singleton):
@@ -0,0 +1,129 @@
+import json
+import re
+
+from pushserver.resources import codec
+
+__all__ = ['PayloadTemplate', 'TEMPLATE_FIELDS', 'compile_payload_templates']
+
+
+# Fields of a wake up request available in templates, in the order
+# of the arguments given to the headers and payload classes
+TEMPLATE_FIELDS = ('app_id', 'event', 'token', 'call_id', 'sip_from',
+                   'from_display_name', 'sip_to', 'media_type', 'silent',
+                   'reason', 'badge', 'filename', 'filetype', 'account',
+                   'content', 'content_type')
+
+PLACEHOLDER = re.compile(r'\$\{(\w+)\}')
+
+
+class PayloadTemplate(object):
+    """
+    A push notification payload written as JSON with ${field} placeholders.
+
+    The template is compiled once into chunks of serialized JSON and
+    fields, rendering only encodes the fields. A placeholder that is a
+    whole JSON string is replaced by the JSON value of the field (null,
+    true, a number or a string), a placeholder inside a string is replaced
+    by the text of the field. With string_data, values under a "data" key
+    are always strings, as FCM requires, a whole string placeholder there
+    is replaced by the text of the field too.
+    """
+
+    def __init__(self, text: str, string_data: bool = False):
+        """
+        :param text: `str` JSON template
+        :param string_data: `bool` (optional) render the values under "data" as strings
+        :raise ValueError: if the template is not valid JSON or uses an unknown field
+        """
+        self.text = text
+        self.string_data = string_data
+        self.parts = []
+        self._compile(json.loads(text))
+
+    def _emit(self, chunk: bytes) -> None:
+        if self.parts and isinstance(self.parts[-1], bytes):
+            self.parts[-1] += chunk
+        else:
+            self.parts.append(chunk)
+
+    def _field(self, name: str, whole: bool) -> None:
+        if name not in TEMPLATE_FIELDS:
+            raise ValueError(f'unknown field ${{{name}}}')
+        self.parts.append((name, whole))
+
+    def _compile(self, value, in_data: bool = False) -> None:
+        if isinstance(value, dict):
+            self._emit(b'{')
+            for index, (key, item) in enumerate(value.items()):
+                if index:
+                    self._emit(b', ')
+                self._emit(json.dumps(key).encode() + b': ')
+                self._compile(item, in_data or (self.string_data and key == 'data'))
+            self._emit(b'}')
+        elif isinstance(value, list):
+            self._emit(b'[')
+            for index, item in enumerate(value):
+                if index:
+                    self._emit(b', ')
+                self._compile(item, in_data)
+            self._emit(b']')
+        elif isinstance(value, str) and PLACEHOLDER.search(value):
+            match = PLACEHOLDER.fullmatch(value)
+            if match and not in_data:
+                self._field(match.group(1), whole=True)
+                return
+            self._emit(b'"')
+            position = 0
+            for match in PLACEHOLDER.finditer(value):
+                self._emit(json.dumps(value[position:match.start()])[1:-1].encode())
+                self._field(match.group(1), whole=False)
+                position = match.end()
+            self._emit(json.dumps(value[position:])[1:-1].encode() + b'"')
+        else:
+            self._emit(json.dumps(value).encode())
+
+    def render(self, values: dict) -> bytes:
+        """
+        :param values: `dict` with the fields of the wake up request
+        :return: `bytes` serialized JSON payload
+        """
+        chunks = []
+        for part in self.parts:
+            if isinstance(part, bytes):
+                chunks.append(part)
+                continue
+            name, whole = part
+            value = values.get(name)
+            if whole:
+                chunks.append(codec.dumpb(value))
+            else:
+                chunks.append(codec.dumpb('' if value is None else str(value))[1:-1])
+        return b''.join(chunks)
+
+
+def compile_payload_templates(config_dict, platform: str = None) -> dict:
+    """
+    Compile the payload templates of an app
+
+    :param config_dict: section of the app in applications.ini,
+                        payload_template is used for any event and
+                        payload_template_<event> for a single event
+    :param platform: `str` (optional) platform of the app, values under
+                     "data" are rendered as strings for 'firebase'
+    :return: a `dict` with event (None for any event) and PayloadTemplate
+    :raise ValueError: if a template is not valid
+    """
+    templates = {}
+    for option, text in config_dict.items():
+        if option == 'payload_template':
+            event = None
+        elif option.startswith('payload_template_'):
+            event = option[len('payload_template_'):]
+        else:
+            continue
+
+        try:
+            templates[event] = PayloadTemplate(text, string_data=platform == 'firebase')
+        except ValueError as e:
+            raise ValueError(f'{option} - bad template: {e}')
+    return templates
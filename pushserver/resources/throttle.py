@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+
+from pushserver.resources.delivery import PRIORITY_CLASSES
+from pushserver.resources.metrics import LatencyStats
+
+__all__ = ['TokenBucket']
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of the pushes sent to the upstream of an application.
+
+    Up to burst pushes are sent at once, then rate pushes per second.
+    Pushes over the limit are not rejected, they wait for a token. Waiting
+    pushes get the tokens by priority class, in arrival order within a
+    class, so a call wake up does not wait behind a burst of messages.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        :param rate: `float` pushes per second
+        :param burst: `int` (optional) pushes that can be sent at once, defaults to rate
+        """
+        if rate <= 0 or (burst is not None and burst <= 0):
+            raise ValueError('rate and burst must be positive')
+        self.rate = rate
+        self.burst = burst if burst else max(int(rate), 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.wait_time = LatencyStats()
+        self.throttled = 0
+        self._waiters = {name: deque() for name in PRIORITY_CLASSES}
+        self._timer = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _waiting_before(self, priority: str) -> bool:
+        index = PRIORITY_CLASSES.index(priority)
+        return any(self._waiters[name] for name in PRIORITY_CLASSES[:index + 1])
+
+    async def acquire(self, priority: str = 'bulk') -> float:
+        """
+        Wait until a push can be sent
+        :param priority: `str` priority class of the push (see delivery.priority_class)
+        :return: `float` seconds waited
+        """
+        self._refill()
+        if self.tokens >= 1 and not self._waiting_before(priority):
+            self.tokens -= 1
+            self.wait_time.add(0.0)
+            return 0.0
+
+        self.throttled += 1
+        started_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                try:
+                    self._waiters[priority].remove(future)
+                except ValueError:
+                    pass
+            else:
+                # the token was given while the caller was cancelled
+                self.tokens += 1
+            raise
+        delay = time.monotonic() - started_at
+        self.wait_time.add(delay)
+        return delay
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self.waiting:
+            return
+        delay = max(1 - self.tokens, 0) / self.rate
+        self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._refill()
+        for name in PRIORITY_CLASSES:
+            waiters = self._waiters[name]
+            while waiters and self.tokens >= 1:
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                future.set_result(None)
+                self.tokens -= 1
+        self._schedule()
+
+    def stats(self) -> dict:
+        return {'rate': self.rate,
+                'burst': self.burst,
+                'throttled': self.throttled,
+                'waiting': self.waiting,
+                'wait_time': self.wait_time.stats()}
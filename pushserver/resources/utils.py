@@ -1,5 +1,4 @@
 import hashlib
-import json
 import logging
 import socket
 import ssl
@@ -7,8 +6,10 @@ import time
 
 from ipaddress import ip_address
 
+from pushserver.resources import codec
+
 __all__ = ['callid_to_uuid', 'fix_non_serializable_types', 'resources_available', 'ssl_cert', 'try_again', 'check_host',
-           'log_event', 'fix_device_id', 'fix_platform_name', 'log_incoming_request']
+           'log_enabled', 'log_event', 'fix_device_id', 'fix_platform_name', 'log_incoming_request']
 
 
 def callid_to_uuid(call_id: str) -> str:
@@ -55,9 +56,9 @@ def fix_non_serializable_types(obj):
 
     elif isinstance(obj, str):
         try:
-            dict_obj = json.loads(obj)
+            dict_obj = codec.loads(obj)
             return fix_non_serializable_types(dict_obj)
-        except json.decoder.JSONDecodeError:
+        except codec.DecodeError:
             return obj
 
     elif isinstance(obj, (bool, int, float)):
@@ -140,31 +141,37 @@ def check_host(host, allowed_hosts) -> bool:
     return False
 
 
+LOG_LEVELS = {'info': logging.INFO,
+              'error': logging.ERROR,
+              'warn': logging.WARNING,
+              'deb': logging.DEBUG,
+              'debug': logging.DEBUG}
+
+
+def log_enabled(loggers: dict, level: str = 'deb') -> bool:
+    """
+    Check if messages of a level are written, to skip building them if not.
+    :param loggers: `dict` global logging instances to write messages (params.loggers)
+    :param level: `str` info, error, deb or warn
+    """
+    levelno = LOG_LEVELS.get(level)
+    return levelno is not None and loggers['to_journal'].isEnabledFor(levelno)
+
+
 def log_event(loggers: dict, msg: str, level: str = 'deb') -> None:
     """
     Write log messages into log file and in journal if specified.
+    The level of the logger is set with the configuration (debug).
     :param loggers: `dict` global logging instances to write messages (params.loggers)
     :param msg: `str` message to write
     :param level: `str` info, error, deb or warn
-    :param to_file: `bool` write just in file if True
     """
-    logger = loggers.get('to_journal')
-    if logger.level != logging.DEBUG and loggers['debug'] is True:
-        logger.setLevel(logging.DEBUG)
-    elif logger.level != logging.INFO and loggers['debug'] is False:
-        logger.setLevel(logging.INFO)
-
-    if level == 'info':
-        logger.info(msg)
-
-    elif level == 'error':
-        logger.error(msg)
-
-    elif level == 'warn':
-        logger.warning(msg)
-
-    elif level in ('deb', 'debug'):
-        logger.debug(msg)
+    levelno = LOG_LEVELS.get(level)
+    if levelno is None:
+        return
+    logger = loggers['to_journal']
+    if logger.isEnabledFor(levelno):
+        logger.log(levelno, msg)
 
 
 def fix_device_id(device_id_to_fix: str) -> str:
@@ -0,0 +1,66 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from pushserver.resources import settings
+from pushserver.resources.storage import storage
+from pushserver.resources.storage.storage import FileStorage
+
+
+class FileStorageJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        for patcher in (mock.patch.object(settings, 'params', SimpleNamespace(loggers={}), create=True),
+                        mock.patch.object(storage, 'log_event'),
+                        mock.patch.object(FileStorage, '_path', self._path)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _path(self, suffix=''):
+        return os.path.join(self.spool_dir, f'{FileStorage.SNAPSHOT}{suffix}')
+
+    @staticmethod
+    def contact(device_id):
+        return SimpleNamespace(token=f'token-{device_id}', platform='firebase',
+                               app_id='app', device_id=device_id)
+
+    def restart(self, file_storage=None):
+        if file_storage is not None:
+            file_storage.close()
+        file_storage = FileStorage()
+        file_storage.load()
+        self.addCleanup(file_storage.close)
+        return file_storage
+
+    def test_replay(self):
+        file_storage = self.restart()
+        file_storage.add('alice', self.contact('a1'))
+        file_storage.add('alice', self.contact('a2'))
+        file_storage.remove('alice', 'app', 'a1')
+
+        file_storage = self.restart(file_storage)
+        self.assertEqual(list(file_storage['alice']), ['app-a2'])
+
+    def test_append_after_incomplete_record(self):
+        record = pickle.dumps(('add', 'bob', 'app-b1', {}))
+        with open(self._path('.journal'), 'wb') as f:
+            f.write(record[:len(record) // 2])
+
+        file_storage = self.restart()
+        self.assertEqual(file_storage['bob'], {})
+        file_storage.add('alice', self.contact('a1'))
+
+        storage.log_event.reset_mock()
+        file_storage = self.restart(file_storage)
+        self.assertEqual(list(file_storage['alice']), ['app-a1'])
+        storage.log_event.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()